@@ -1,10 +1,16 @@
 import logging
-import itertools
+import sqlite3
+import time
+from array import array
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 from threading import Lock
 
 from src.globals import *
+from src.util import TimedLock
 
+# what gets passed to Cache.assignMessageId, the cache itself stores messages
+# column-wise and hands out _MessageView objects that work the same way
 class CachedMessage():
 	__slots__ = ('user_id', 'time', 'warned', 'upvoted')
 	def __init__(self, user_id=None):
@@ -19,51 +25,616 @@ class CachedMessage():
 	def addUpvote(self, user):
 		self.upvoted.add(user.id)
 
-class Cache():
+_F_PRESENT = 1
+_F_WARNED = 2
+
+class _MessageView():
+	__slots__ = ('b', 'i', 'lock')
+	def __init__(self, b, i, lock):
+		self.b = b
+		self.i = i
+		self.lock = lock # protects changes to the message
+	@property
+	def user_id(self):
+		return self.b.users[self.i] or None
+	@property
+	def time(self):
+		return datetime.fromtimestamp(self.b.times[self.i])
+	@property
+	def warned(self):
+		return bool(self.b.flags[self.i] & _F_WARNED)
+	@warned.setter
+	def warned(self, value):
+		with self.lock:
+			if value:
+				self.b.flags[self.i] |= _F_WARNED
+			else:
+				self.b.flags[self.i] &= ~_F_WARNED
+			self.b.changed(self.i)
+	@property
+	def upvoted(self):
+		return tuple(self.b.upvoted.get(self.i, ()))
+	def isExpired(self):
+		return time.time() >= self.b.times[self.i] + 86400
+	def hasUpvoted(self, user):
+		a = self.b.upvoted.get(self.i, None)
+		if a is None:
+			return False
+		j = bisect_left(a, user.id)
+		return j < len(a) and a[j] == user.id
+	def addUpvote(self, user):
+		with self.lock:
+			a = self.b.upvoted.setdefault(self.i, array('q'))
+			j = bisect_left(a, user.id)
+			if j < len(a) and a[j] == user.id:
+				return
+			a.insert(j, user.id)
+			self.b.changed(self.i)
+
+# Telegram message ids of one message for each recipient, by recipient slot.
+# starts out as a dict and switches to an array once that takes less memory
+class _Recipients():
+	__slots__ = ('d', 'a')
 	def __init__(self):
+		self.d = {} # dict(slot -> message id)
+		self.a = None # array of message ids, 0 if there is none
+	def get(self, slot):
+		if self.a is None:
+			return self.d.get(slot, None)
+		if slot < len(self.a):
+			return self.a[slot] or None
+		return None
+	def set(self, slot, value):
+		if self.a is None:
+			self.d[slot] = value
+			n = len(self.d)
+			# an array costs 8 bytes per slot, a dict entry about 64
+			if n >= 16 and n & (n - 1) == 0 and max(self.d.keys()) < 8 * n:
+				self.a = array('q', bytes(8 * (max(self.d.keys()) + 1)))
+				for k, v in self.d.items():
+					self.a[k] = v
+				self.d = None
+			return
+		if slot >= len(self.a):
+			self.a.frombytes(bytes(8 * (slot + 1 - len(self.a))))
+		self.a[slot] = value
+	def items(self):
+		if self.a is None:
+			return list(self.d.items())
+		return list((slot, v) for slot, v in enumerate(self.a) if v != 0)
+
+# optional on-disk copy of the cache, so it survives restarts
+class CacheStore():
+	def __init__(self, path):
+		self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self.db.execute("PRAGMA journal_mode = WAL")
+		self.db.execute("PRAGMA synchronous = NORMAL")
+		self.db.execute("""
+CREATE TABLE IF NOT EXISTS `messages` (
+	`msid` INTEGER NOT NULL,
+	`hour` INTEGER NOT NULL,
+	`user_id` BIGINT,
+	`time` INTEGER NOT NULL,
+	`warned` TINYINT NOT NULL,
+	`upvoted` BLOB NOT NULL,
+	PRIMARY KEY (`msid`)
+);
+		""".strip())
+		# (uid, opaque) pairs as array('q'), in as many rows as there were saves
+		self.db.execute("""
+CREATE TABLE IF NOT EXISTS `mappings` (
+	`msid` INTEGER NOT NULL,
+	`data` BLOB NOT NULL
+);
+		""".strip())
+		self.db.execute("CREATE INDEX IF NOT EXISTS `mappings_msid` ON `mappings` (`msid`)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS `counter` (`value` INTEGER NOT NULL)")
+		# the connection is shared by the scheduler, handler and main thread
 		self.lock = Lock()
-		self.counter = itertools.count()
-		self.msgs = {} # dict(msid -> CachedMessage)
-		self.idmap = {} # dict(uid -> dict(msid -> opaque))
-	def _saveMapping(self, x, uid, msid, data):
-		if uid not in x.keys():
-			x[uid] = {}
-		x[uid][msid] = data
-	def _lookupMapping(self, x, uid, msid, data):
-		if uid not in x.keys():
-			return None
+	def close(self):
+		with self.lock:
+			self.db.close()
+	def getCounter(self):
+		with self.lock:
+			row = self.db.execute("SELECT `value` FROM counter").fetchone()
+		return 0 if row is None else row[0]
+	def save(self, counter, msgs, mappings, expireHour):
+		# msgs: list of (msid, hour, user_id, time, warned, upvoted)
+		# mappings: dict(msid -> array of uid, opaque, uid, opaque...)
+		with self.lock:
+			self.db.execute("BEGIN")
+			try:
+				self.db.executemany("REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+					((msid, hour, user_id, t, warned, upvoted.tobytes())
+					for msid, hour, user_id, t, warned, upvoted in msgs))
+				self.db.executemany("INSERT INTO mappings VALUES (?, ?)",
+					((msid, a.tobytes()) for msid, a in mappings.items()))
+				self.db.execute("DELETE FROM messages WHERE `hour` < ?", (expireHour, ))
+				# msids grow with time, everything before the oldest message is expired
+				self.db.execute("DELETE FROM mappings WHERE `msid` < "
+					"coalesce((SELECT min(`msid`) FROM messages), ?)", (counter, ))
+				self.db.execute("DELETE FROM counter")
+				self.db.execute("INSERT INTO counter VALUES (?)", (counter, ))
+			except:
+				self.db.execute("ROLLBACK")
+				raise
+			self.db.execute("COMMIT")
+	def load(self, minHour):
+		# returns a list of (msid, hour, user_id, time, warned, upvoted) and
+		# a list of (msid, array of uid, opaque...)
+		with self.lock:
+			sql = "SELECT * FROM messages WHERE `hour` >= ? ORDER BY `msid`"
+			msgs = self.db.execute(sql, (minHour, )).fetchall()
+			sql = "SELECT `msid`, `data` FROM mappings WHERE `msid` >= ? ORDER BY rowid"
+			first = msgs[0][0] if len(msgs) > 0 else 0
+			mappings = self.db.execute(sql, (first, )).fetchall()
+		msgs = list((msid, hour, user_id, t, bool(warned), array('q', upvoted))
+			for msid, hour, user_id, t, warned, upvoted in msgs)
+		return msgs, list((msid, array('q', data)) for msid, data in mappings)
+
+# approximate memory use, see `bench.py cache`
+_MESSAGE_BYTES = 32
+_AUTHOR_BYTES = 120 # per author and bucket
+_UPVOTED_BYTES = 160 # per message with upvotes
+_MAPPING_BYTES = 32
+_RECIPIENTS_BYTES = 200 # per message and shard
+_REVMAP_BYTES = 240 # per user and bucket
+
+# messages are grouped by the hour they were created in, so that expiring
+# them is just dropping the oldest groups. a bucket is also closed early
+# once it gets big, so that the memory limit can drop smaller parts
+# msids in a bucket are consecutive, message i of each column is msid first+i
+class _Bucket():
+	__slots__ = ('hour', 'first', 'users', 'times', 'flags', 'upvoted', 'dirty',
+		'authors', 'idmap', 'revmap', 'mappings')
+	def __init__(self, hour, first, shards, track=False):
+		self.hour = hour
+		self.first = first # lowest msid in this bucket
+		self.users = array('q') # author, 0 if there is none
+		self.times = array('q') # creation time in unix seconds
+		self.flags = array('B') # _F_* bits
+		self.upvoted = {} # dict(i -> sorted array of uids), only if there are any
+		self.dirty = set() if track else None # messages changed since last flush
+		self.authors = {} # dict(uid -> array of msids)
+		# one of each per mapping shard, indexed by the shard's own slots:
+		self.idmap = list({} for _ in range(shards)) # dict(msid -> _Recipients)
+		# for lookups in the other direction:
+		# dict(slot -> (sorted array of message ids, array of msids))
+		self.revmap = list({} for _ in range(shards))
+		self.mappings = [0] * shards # number of mappings saved, per shard
+	def append(self, user_id, t, flags, changed=True):
+		if user_id:
+			if user_id not in self.authors.keys():
+				self.authors[user_id] = array('q')
+			self.authors[user_id].append(self.first + len(self.flags))
+		self.users.append(user_id or 0)
+		self.times.append(t)
+		self.flags.append(_F_PRESENT | flags)
+		if changed:
+			self.changed(len(self.flags) - 1)
+	def pad(self, end):
+		# adds empty entries until the next message would get msid `end`
+		while self.first + len(self.flags) < end:
+			self.users.append(0)
+			self.times.append(0)
+			self.flags.append(0)
+	def changed(self, i):
+		if self.dirty is not None:
+			self.dirty.add(i)
+	def size(self):
+		return (len(self.flags) * _MESSAGE_BYTES + len(self.upvoted) * _UPVOTED_BYTES +
+			len(self.authors) * _AUTHOR_BYTES + sum(self.mappings) * _MAPPING_BYTES +
+			sum(len(d) for d in self.idmap) * _RECIPIENTS_BYTES +
+			sum(len(d) for d in self.revmap) * _REVMAP_BYTES)
+	def msids(self):
+		return list(self.first + i for i, f in enumerate(self.flags) if f & _F_PRESENT)
+
+# mappings are split by uid, each part with its own lock and slots
+class _Shard():
+	__slots__ = ('lock', 'slots', 'uids', 'unsaved', 'evicted', 'evictedMisses', 'lookups')
+	def __init__(self):
+		self.lock = TimedLock(Lock())
+		# users are given a slot the first time a mapping is saved for them
+		self.slots = {} # dict(uid -> slot)
+		self.uids = [] # slot -> uid
+		self.unsaved = {} # dict(msid -> array of uid, opaque, ...) not yet stored
+		# range of message ids that were evicted: dict(slot -> [lowest, highest, hour])
+		self.evicted = {}
+		self.evictedMisses = 0
+		self.lookups = {} # dict(caller -> [hits, misses])
+
+def _sumLockStats(locks):
+	ret = {"acquired": 0, "contended": 0, "wait_total_ms": 0, "wait_max_ms": 0}
+	for lock in locks:
+		for k, v in lock.getStats().items():
+			ret[k] = max(ret[k], v) if k == "wait_max_ms" else ret[k] + v
+	return ret
+
+class Cache():
+	def __init__(self, store=None, shards=8, budget=None):
+		# assigning msids and adding or dropping buckets, held only briefly
+		self.lock = TimedLock(Lock())
+		self.buckets = [] # list of _Bucket, oldest first, replaced on removal
+		self.shards = list(_Shard() for _ in range(shards)) # by uid
+		# changes to a message through _MessageView, by msid
+		self.msgLocks = list(TimedLock(Lock()) for _ in range(shards))
+		self.store = store
+		self.nextMsid = 0 if store is None else store.getCounter()
+		# everything before this is loaded from the store on first access
+		self.firstMsid = self.nextMsid
+		self.loaded = store is None
+		self.loadLock = Lock()
+		self.flushLock = Lock()
+		# oldest messages are evicted to stay below this many bytes
+		self.budget = budget
+		self.evicted = 0 # number of messages
+		self.evictedIds = set() # msids evicted since the last expire()
+		# statistics
+		self.statsLock = Lock()
+		self.expireRuns = 0
+		self.expired = 0 # number of messages
+		self.expireLast = 0.0 # seconds
+		self.expireMax = 0.0
+		self.expireLockMax = 0.0
+	def register_tasks(self, sched):
+		if self.store is not None:
+			sched.register(self.flush, seconds=5)
+	def close(self):
+		if self.store is None:
+			return
+		try:
+			self.flush()
+		except Exception as e:
+			logging.exception("Failed to store the message cache")
+		self.store.close()
+	def _mappingsPerUser(self, buckets):
+		ret = []
+		for n, sh in enumerate(self.shards):
+			with sh.lock:
+				counts = [0] * len(sh.uids)
+				for b in buckets:
+					for slot, rev in b.revmap[n].items():
+						counts[slot] += len(rev[0])
+			ret.extend(c for c in counts if c > 0)
+		ret.sort()
+		return ret
+	def getStats(self):
+		buckets = self.buckets
+		counts = self._mappingsPerUser(buckets)
+		def percentile(p):
+			return counts[min(len(counts) * p // 100, len(counts) - 1)] if len(counts) > 0 else 0
+		ret = {
+			"messages": sum(len(b.msids()) for b in buckets),
+			"mappings": sum(sum(b.mappings) for b in buckets),
+			"buckets": len(buckets),
+			"users": len(counts),
+			"mappings_per_user_p50": percentile(50),
+			"mappings_per_user_p99": percentile(99),
+			"size_kib": sum(b.size() for b in buckets) // 1024,
+			"evicted": self.evicted,
+			"evicted_misses": sum(sh.evictedMisses for sh in self.shards),
+			"expire_runs": self.expireRuns,
+			"expire_items": self.expired,
+			"expire_last_ms": round(self.expireLast * 1000, 1),
+			"expire_max_ms": round(self.expireMax * 1000, 1),
+			"expire_lock_max_ms": round(self.expireLockMax * 1000, 1),
+		}
+		if self.budget is not None:
+			ret["budget_kib"] = self.budget // 1024
+		lookups = {}
+		for sh in self.shards:
+			with sh.lock:
+				for caller, (hits, misses) in sh.lookups.items():
+					a = lookups.setdefault(caller, [0, 0])
+					a[0] += hits
+					a[1] += misses
+		for caller, (hits, misses) in sorted(lookups.items()):
+			ret["lookup_%s_hits" % caller] = hits
+			ret["lookup_%s_misses" % caller] = misses
+		ret.update(("lock_" + k, v) for k, v in self.getLockStats().items())
+		return ret
+	def getLockStats(self):
+		ret = {}
+		for name, locks in (("alloc", (self.lock, )), ("mappings", (sh.lock for sh in self.shards)),
+				("messages", self.msgLocks)):
+			for k, v in _sumLockStats(locks).items():
+				ret[name + "_" + k] = v
+		return ret
+	def flush(self):
+		# the scheduler and close() may both get here, the counter must not
+		# go backwards
+		with self.flushLock:
+			self._flush()
+	def _flush(self):
+		# writes changes to the store, the slow part happens without the locks
+		msgs = []
+		for b in self.buckets:
+			# views add to this under msgLocks, copying it is enough
+			dirty = list(b.dirty)
+			b.dirty.difference_update(dirty)
+			for i in dirty:
+				msgs.append((b.first + i, b.hour, b.users[i] or None, b.times[i],
+					bool(b.flags[i] & _F_WARNED), array('q', b.upvoted.get(i, ()))))
+		unsaved = []
+		mappings = {}
+		for sh in self.shards:
+			with sh.lock:
+				d, sh.unsaved = sh.unsaved, {}
+			unsaved.append(d)
+			for msid, a in d.items():
+				mappings.setdefault(msid, array('q')).extend(a)
+		# read last so that it is past every msid collected above
+		counter = self.nextMsid
+		if len(msgs) == 0 and len(mappings) == 0:
+			return
+		try:
+			self.store.save(counter, msgs, mappings, Cache._hour() - 24)
+		except:
+			# try again next time
+			for msid, *_ in msgs:
+				b = self._bucket(msid)
+				if b is not None:
+					b.dirty.add(msid - b.first)
+			for sh, d in zip(self.shards, unsaved):
+				with sh.lock:
+					for msid, a in d.items():
+						a.extend(sh.unsaved.get(msid, ()))
+						sh.unsaved[msid] = a
+			raise
+		logging.debug("Stored %d messages and mappings of %d messages", len(msgs), len(mappings))
+	def _ensureLoaded(self):
+		# restores what was cached before the last restart
+		if self.loaded:
+			return
+		with self.loadLock:
+			if self.loaded:
+				return
+			self._load()
+			self.loaded = True
+	def _load(self):
+		t = time.monotonic()
+		msgs, mappings = self.store.load(Cache._hour() - 24)
+		old = []
+		for msid, hour, user_id, ts, warned, upvoted in msgs:
+			if len(old) == 0 or old[-1].hour != hour:
+				old.append(_Bucket(hour, msid, len(self.shards), True))
+			b = old[-1]
+			# gaps would break the indexing
+			b.pad(msid)
+			b.append(user_id, ts, _F_WARNED if warned else 0, False)
+			if len(upvoted) > 0:
+				b.upvoted[msid - b.first] = array('q', sorted(upvoted))
+		if len(old) > 0:
+			# messages assigned right before the last flush may be missing,
+			# the ones assigned since must not take their place
+			old[-1].pad(self.firstMsid)
+		n = 0
+		for sh in self.shards:
+			sh.lock.acquire()
+		try:
+			for msid, a in mappings:
+				for i in range(0, len(a), 2):
+					self._saveMapping(old, a[i], msid, a[i+1], stored=True)
+				n += len(a) // 2
+		finally:
+			for sh in self.shards:
+				sh.lock.release()
+		with self.lock:
+			self.buckets = old + self.buckets
+		logging.info("Loaded %d messages and %d mappings from cache store in %.1fs",
+			len(msgs), n, time.monotonic() - t)
+	@staticmethod
+	def _hour():
+		return int(time.time() // 3600)
+	def _bucket(self, msid, buckets=None):
+		# msids only grow, so the buckets are sorted by them too
+		for b in reversed(self.buckets if buckets is None else buckets):
+			if msid >= b.first:
+				return b
+		return None
+	def _shard(self, uid):
+		n = uid % len(self.shards)
+		return n, self.shards[n]
+	def _saveMapping(self, buckets, uid, msid, data, stored=False):
+		# needs the uid's shard lock
+		b = self._bucket(msid, buckets)
+		if b is None:
+			return # already expired
+		n, sh = self._shard(uid)
+		if not stored and self.store is not None:
+			if msid not in sh.unsaved.keys():
+				sh.unsaved[msid] = array('q')
+			sh.unsaved[msid].extend((uid, data))
+		slot = sh.slots.get(uid, None)
+		if slot is None:
+			slot = sh.slots[uid] = len(sh.uids)
+			sh.uids.append(uid)
+		idmap, revmap = b.idmap[n], b.revmap[n]
+		if msid not in idmap.keys():
+			idmap[msid] = _Recipients()
+		idmap[msid].set(slot, data)
+		if slot not in revmap.keys():
+			revmap[slot] = (array('q'), array('q'))
+		# message ids in a chat grow, so this almost always appends
+		ids, msids = revmap[slot]
+		i = bisect_right(ids, data)
+		ids.insert(i, data)
+		msids.insert(i, msid)
+		b.mappings[n] += 1
+	def _findMapping(self, n, slot, msid, data):
+		# needs the shard lock
 		if msid is not None:
-			return x[uid].get(msid, None)
+			b = self._bucket(msid)
+			if b is None or msid not in b.idmap[n].keys():
+				return None
+			return b.idmap[n][msid].get(slot)
 		# data is not None
-		gen = ( msid for msid, _data in x[uid].items() if _data == data )
-		return next(gen, None)
+		for b in reversed(self.buckets):
+			rev = b.revmap[n].get(slot, None)
+			if rev is None or not rev[0][0] <= data <= rev[0][-1]:
+				continue
+			ids, msids = rev
+			i = bisect_left(ids, data)
+			while i < len(ids) and ids[i] == data:
+				# the mapping might have been overwritten since
+				if b.idmap[n][msids[i]].get(slot) == data:
+					return msids[i]
+				i += 1
+		return None
+	def _lookupMapping(self, uid, msid, data, caller, final=True):
+		# final: a miss is not going to be retried
+		n, sh = self._shard(uid)
+		with sh.lock:
+			slot = sh.slots.get(uid, None)
+			ret = None if slot is None else self._findMapping(n, slot, msid, data)
+			if ret is None and not final:
+				return None
+			if caller not in sh.lookups.keys():
+				sh.lookups[caller] = [0, 0]
+			sh.lookups[caller][0 if ret is not None else 1] += 1
+			if ret is None and data is not None and slot is not None:
+				r = sh.evicted.get(slot, None)
+				if r is not None and r[0] <= data <= r[1]:
+					sh.evictedMisses += 1
+			return ret
 
 	def assignMessageId(self, cm):
+		t = int(time.time())
 		with self.lock:
-			ret = next(self.counter)
-			self.msgs[ret] = cm
+			ret = self.nextMsid
+			self.nextMsid += 1
+			hour = t // 3600
+			if len(self.buckets) == 0 or self.buckets[-1].hour != hour or (self.budget is not None
+					and self.buckets[-1].size() > self.budget // 32):
+				dropped = self._evict()
+				self.buckets.append(_Bucket(hour, ret, len(self.shards), self.store is not None))
+			else:
+				dropped = []
+			b = self.buckets[-1]
+			b.append(cm.user_id, t, _F_WARNED if cm.warned else 0)
+			if len(cm.upvoted) > 0:
+				b.upvoted[ret - b.first] = array('q', sorted(cm.upvoted))
+		if len(dropped) > 0:
+			self._forgetEvicted(dropped)
 		return ret
-	def getMessage(self, msid):
+	def _evict(self):
+		# needs self.lock, returns the buckets that were dropped
+		if self.budget is None:
+			return []
+		sizes = list(b.size() for b in self.buckets)
+		total = sum(sizes)
+		n = 0
+		while n < len(self.buckets) and total > self.budget:
+			total -= sizes[n]
+			n += 1
+		if n == 0:
+			return []
+		dropped = self.buckets[:n]
+		self.buckets = self.buckets[n:]
+		count = sum(len(b.msids()) for b in dropped)
+		self.evicted += count
+		logging.warning("Cache is over its memory limit, evicted %d messages (%d total)",
+			count, self.evicted)
+		return dropped
+	def _forgetEvicted(self, dropped):
+		# remember which message ids each user had in there, so that failed
+		# lookups for them can be told apart
+		for n, sh in enumerate(self.shards):
+			with sh.lock:
+				for b in dropped:
+					for slot, (ids, _) in b.revmap[n].items():
+						r = sh.evicted.get(slot, None)
+						if r is None:
+							sh.evicted[slot] = [ids[0], ids[-1], b.hour]
+						else:
+							r[:] = [min(r[0], ids[0]), max(r[1], ids[-1]), max(r[2], b.hour)]
+		ids = set()
+		for b in dropped:
+			ids.update(b.msids())
 		with self.lock:
-			return self.msgs.get(msid, None)
+			self.evictedIds.update(ids)
+	def getMessage(self, msid):
+		if msid < self.firstMsid:
+			self._ensureLoaded()
+		b = self._bucket(msid)
+		if b is None:
+			return None
+		i = msid - b.first
+		if i >= len(b.flags) or not b.flags[i] & _F_PRESENT:
+			return None
+		return _MessageView(b, i, self.msgLocks[msid % len(self.msgLocks)])
+	def getMessagesBy(self, uid):
+		# returns the msids of all cached messages sent by uid
+		self._ensureLoaded()
+		ret = []
+		for b in self.buckets:
+			a = b.authors.get(uid, None)
+			if a is not None:
+				ret.extend(a)
+		return ret
 	def saveMapping(self, uid, msid, data):
-		with self.lock:
-			self._saveMapping(self.idmap, uid, msid, data)
-	def lookupMapping(self, uid, msid=None, data=None):
+		_, sh = self._shard(uid)
+		with sh.lock:
+			self._saveMapping(None, uid, msid, data)
+	def lookupMapping(self, uid, msid=None, data=None, caller="other"):
+		# caller: name for the hit/miss statistics
 		if msid is None and data is None:
 			raise ValueError()
-		with self.lock:
-			return self._lookupMapping(self.idmap, uid, msid, data)
+		if msid is not None and msid < self.firstMsid:
+			self._ensureLoaded()
+		loaded = self.loaded
+		ret = self._lookupMapping(uid, msid, data, caller, loaded or msid is not None)
+		if ret is None and msid is None and not loaded:
+			self._ensureLoaded()
+			ret = self._lookupMapping(uid, msid, data, caller)
+		return ret
+	def getMappings(self, msid):
+		# returns a list of (uid, opaque) for everyone that has a mapping for msid
+		if msid < self.firstMsid:
+			self._ensureLoaded()
+		b = self._bucket(msid)
+		if b is None:
+			return []
+		ret = []
+		for n, sh in enumerate(self.shards):
+			with sh.lock:
+				r = b.idmap[n].get(msid, None)
+				if r is not None:
+					ret.extend((sh.uids[slot], data) for slot, data in r.items())
+		return ret
 	def expire(self):
-		ids = set()
+		# a bucket goes once its newest message is 24 hours old
+		# returns the msids of all messages dropped since the last call,
+		# including those evicted because of the memory limit
+		limit = Cache._hour() - 24
+		t = time.monotonic()
 		with self.lock:
-			for msid in list(self.msgs.keys()):
-				if not self.msgs[msid].isExpired():
-					continue
-				ids.add(msid)
-				del self.msgs[msid] # delete from primary cache
-				for d in self.idmap.values(): # delete from id mapping
-					d.pop(msid, None)
-		if len(ids) > 0:
-			logging.debug("Expired %d entries from cache", len(ids))
+			t2 = time.monotonic()
+			n = 0
+			while n < len(self.buckets) and self.buckets[n].hour < limit:
+				n += 1
+			dropped = self.buckets[:n]
+			# replaced instead of modified, others may be looking through it
+			self.buckets = self.buckets[n:]
+			evicted, self.evictedIds = self.evictedIds, set()
+			t2 = time.monotonic() - t2
+		for sh in self.shards:
+			with sh.lock:
+				sh.evicted = {slot: r for slot, r in sh.evicted.items() if r[2] >= limit}
+		# outside of the lock since freeing everything takes a moment
+		ids = set()
+		for b in dropped:
+			ids.update(b.msids())
+		del dropped
+		expired = len(ids)
+		ids.update(evicted)
+		t = time.monotonic() - t
+		with self.statsLock:
+			self.expireRuns += 1
+			self.expired += expired
+			self.expireLast = t
+			self.expireMax = max(self.expireMax, t)
+			self.expireLockMax = max(self.expireLockMax, t2)
+		if expired > 0:
+			logging.debug("Expired %d entries from cache in %.1fms", expired, t * 1000)
 		return ids
@@ -1,6 +1,6 @@
 import logging
 from datetime import datetime, timedelta
-from threading import Lock
+from threading import Lock, Thread
 
 import src.replies as rp
 from src.globals import *
@@ -18,9 +18,15 @@ enable_signing = None
 allow_remove_command = None
 media_limit_period = None
 sign_interval = None
+archive_after = None
+backup_dir = None
+backup_interval = None
+backup_keep = None
+backup_lock = Lock()
 
 def init(config, _db, _ch):
-	global db, ch, spam_scores, blacklist_contact, enable_signing, allow_remove_command, media_limit_period, sign_interval
+	global db, ch, spam_scores, blacklist_contact, enable_signing, allow_remove_command, media_limit_period, sign_interval, archive_after
+	global backup_dir, backup_interval, backup_keep
 	db = _db
 	ch = _ch
 	spam_scores = ScoreKeeper()
@@ -31,6 +37,11 @@ def init(config, _db, _ch):
 	if "media_limit_period" in config.keys():
 		media_limit_period = timedelta(hours=int(config["media_limit_period"]))
 	sign_interval = timedelta(seconds=int(config.get("sign_limit_interval", 600)))
+	if config.get("archive_after_days"):
+		archive_after = timedelta(days=int(config["archive_after_days"]))
+	backup_dir = config.get("backup_dir")
+	backup_interval = int(config.get("backup_interval_hours", 24))
+	backup_keep = int(config.get("backup_keep", 7))
 
 	if config.get("locale"):
 		rp.localization = __import__("src.replies_" + config["locale"],
@@ -47,14 +58,53 @@ def register_tasks(sched):
 	sched.register(spam_scores.scheduledTask, seconds=SPAM_INTERVAL_SECONDS)
 	# warning removal
 	def task():
-		now = datetime.now()
-		for user in db.iterateUsers():
-			if not user.isJoined():
-				continue
-			if user.warnExpiry is not None and now >= user.warnExpiry:
-				with db.modifyUser(id=user.id) as user:
-					user.removeWarning()
-	sched.register(task, minutes=15)
+		ids = db.expireWarnings(datetime.now())
+		if len(ids) > 0:
+			logging.debug("Removed a warning from %d users", len(ids))
+	sched.register(task, minutes=1)
+	# archiving users who left long ago
+	def task():
+		before = datetime.now() - archive_after
+		n, limit = 0, 1000
+		while True: # in small steps to not block everything else
+			ids = db.archiveUsers(before, limit)
+			n += len(ids)
+			if len(ids) < limit:
+				break
+		if n > 0:
+			logging.info("Archived %d users", n)
+	if archive_after is not None:
+		sched.register(task, hours=1)
+	# backups, in a separate thread since they may take a while
+	def backup():
+		if not backup_lock.acquire(blocking=False):
+			logging.warning("Previous backup still running, skipping")
+			return
+		try:
+			if db.backup(backup_dir, backup_keep) is None:
+				logging.warning("Backups are not supported by this database type")
+		except Exception as e:
+			logging.exception("Database backup failed")
+		finally:
+			backup_lock.release()
+	def task():
+		Thread(target=backup, daemon=True).start()
+	if backup_dir is not None:
+		sched.register(task, hours=backup_interval)
+	# statistics
+	def task():
+		checkPopulation()
+		stats = db.getStats()
+		logging.info("Database stats: %s", " ".join("%s=%s" % e for e in sorted(stats.items())))
+		stats = ch.getStats()
+		logging.info("Cache stats: %s", " ".join("%s=%s" % e for e in sorted(stats.items())))
+	sched.register(task, hours=1)
+
+def checkPopulation():
+	drift = db.checkPopulation()
+	if len(drift) > 0:
+		logging.warning("User counters were off by %r, corrected", drift)
+	return drift
 
 def updateUserFromEvent(user, c_user):
 	user.username = c_user.username
@@ -62,22 +112,10 @@ def updateUserFromEvent(user, c_user):
 	user.lastActive = datetime.now()
 
 def getUserByName(username):
-	username = username.lower()
-	# there *should* only be a single joined user with a given username
-	for user in db.iterateUsers():
-		if not user.isJoined():
-			continue
-		if user.username is not None and user.username.lower() == username:
-			return user
-	return None
+	return db.getUserByName(username)
 
 def getUserByOid(oid):
-	for user in db.iterateUsers():
-		if not user.isJoined():
-			continue
-		if user.getObfuscatedId() == oid:
-			return user
-	return None
+	return db.getUserByOid(oid)
 
 def requireUser(func):
 	def wrapper(c_user, *args, **kwargs):
@@ -156,6 +194,9 @@ class Receiver():
 	@staticmethod
 	def stop_invoked(who, delete_out):
 		raise NotImplementedError()
+	@staticmethod
+	def purge(msids):
+		raise NotImplementedError()
 
 class Sender(Receiver): # flawless class hierachy I know...
 	receivers = []
@@ -174,6 +215,11 @@ class Sender(Receiver): # flawless class hierachy I know...
 		logging.debug("stop_invoked(who=%s)", who)
 		for r in Sender.receivers:
 			r.stop_invoked(who, delete_out)
+	@staticmethod
+	def purge(msids):
+		logging.debug("purge(%d msids)", len(msids))
+		for r in Sender.receivers:
+			r.purge(msids)
 
 def registerReceiver(obj):
 	assert issubclass(obj, Receiver)
@@ -211,7 +257,7 @@ def user_join(c_user):
 	user.defaults()
 	user.id = c_user.id
 	updateUserFromEvent(user, c_user)
-	if not any(db.iterateUserIds()):
+	if sum(db.getPopulation().values()) == 0:
 		user.rank = RANKS.admin
 
 	logging.info("%s joined chat", user)
@@ -269,20 +315,22 @@ def get_info_mod(user, msid):
 
 @requireUser
 def get_users(user):
+	d = db.getPopulation()
 	if user.rank < RANKS.mod:
-		n = sum(1 for user in db.iterateUsers() if user.isJoined())
-		return rp.Reply(rp.types.USERS_INFO, count=n)
-	active, inactive, black = 0, 0, 0
-	for user in db.iterateUsers():
-		if user.isBlacklisted():
-			black += 1
-		elif not user.isJoined():
-			inactive += 1
-		else:
-			active += 1
+		return rp.Reply(rp.types.USERS_INFO, count=d["active"])
 	return rp.Reply(rp.types.USERS_INFO_EXTENDED,
-		active=active, inactive=inactive, blacklisted=black,
-		total=active + inactive + black)
+		active=d["active"], inactive=d["inactive"], blacklisted=d["blacklisted"],
+		total=sum(d.values()))
+
+@requireUser
+@requireRank(RANKS.admin)
+def get_stats(user):
+	drift = checkPopulation()
+	stats = {"users_" + k: v for k, v in db.getPopulation().items()}
+	stats["users_drift"] = ", ".join("%s %+d" % e for e in drift.items()) or "none"
+	stats.update(("db_" + k, v) for k, v in db.getStats().items())
+	stats.update(("cache_" + k, v) for k, v in ch.getStats().items())
+	return rp.Reply(rp.types.STATS, stats=stats)
 
 @requireUser
 def get_motd(user):
@@ -295,6 +343,7 @@ def get_motd(user):
 def set_motd(user, arg):
 	with db.modifySystemConfig() as config:
 		config.motd = arg
+	db.flush()
 	logging.info("%s set motd to: %r", user, arg)
 	return rp.Reply(rp.types.SUCCESS)
 
@@ -345,6 +394,7 @@ def promote_user(user, username2, rank):
 		return
 	with db.modifyUser(id=user2.id) as user2:
 		user2.rank = rank
+	db.flush()
 	if rank >= RANKS.admin:
 		_push_system_message(rp.Reply(rp.types.PROMOTED_ADMIN), who=user2)
 	elif rank >= RANKS.mod:
@@ -379,6 +429,7 @@ def warn_user(user, msid, delete=False):
 		with db.modifyUser(id=cm.user_id) as user2:
 			d = user2.addWarning()
 			user2.karma -= KARMA_WARN_PENALTY
+		db.flush()
 		_push_system_message(
 			rp.Reply(rp.types.GIVEN_COOLDOWN, duration=d, deleted=delete),
 			who=user2, reply_to=msid)
@@ -407,6 +458,21 @@ def remove(user, msid, reason):
     logging.info("%s had a message removed by %s for: %s", user2, user, reason)
     return rp.Reply(rp.types.SUCCESS)
 
+@requireUser
+@requireRank(RANKS.mod)
+def purge_messages(user, msid):
+	cm = ch.getMessage(msid)
+	if cm is None or cm.user_id is None:
+		return rp.Reply(rp.types.ERR_NOT_IN_CACHE)
+
+	user2 = db.getUser(id=cm.user_id)
+	if user2.rank >= user.rank:
+		return
+	msids = ch.getMessagesBy(user2.id)
+	Sender.purge(msids)
+	logging.info("%s purged %d messages by %s", user, len(msids), user2)
+	return rp.Reply(rp.types.MESSAGES_PURGED, count=len(msids))
+
 @requireUser
 @requireRank(RANKS.admin)
 def uncooldown_user(user, oid2=None, username2=None):
@@ -427,6 +493,7 @@ def uncooldown_user(user, oid2=None, username2=None):
 		user2.removeWarning()
 		was_until = user2.cooldownUntil
 		user2.cooldownUntil = None
+	db.flush()
 	logging.info("%s removed cooldown from %s (was until %s)", user, user2, format_datetime(was_until))
 	return rp.Reply(rp.types.SUCCESS)
 
@@ -441,6 +508,7 @@ def blacklist_user(user, msid, reason):
 		if user2.rank >= user.rank:
 			return
 		user2.setBlacklisted(reason)
+	db.flush()
 	cm.warned = True
 	Sender.stop_invoked(user2, True) # do this before queueing new messages below
 	_push_system_message(
@@ -461,7 +529,6 @@ def give_karma(user, msid):
 	elif user.id == cm.user_id:
 		return rp.Reply(rp.types.ERR_UPVOTE_OWN_MESSAGE)
 	cm.addUpvote(user)
-	user2 = db.getUser(id=cm.user_id)
 	with db.modifyUser(id=cm.user_id) as user2:
 		user2.karma += KARMA_PLUS_ONE
 	if not user2.hideKarma:
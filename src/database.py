@@ -1,12 +1,19 @@
 import logging
 import os
 import json
+import mmap
 import sqlite3
-from datetime import date, datetime, timedelta, timezone
+import struct
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from contextlib import contextmanager
+from queue import Queue, Empty
 from random import randint
-from threading import RLock
+from threading import Event, Lock, RLock, Thread, current_thread
 
 from src.globals import *
+from src.util import TimedLock
 
 # what's inside the db
 
@@ -21,9 +28,67 @@ USER_PROPS = (
 	"cooldownUntil", "blacklistReason", "warnings", "warnExpiry", "karma",
 	"hideKarma", "debugEnabled", "tripcode"
 )
+USER_TIMESTAMP_PROPS = ("joined", "left", "lastActive", "cooldownUntil", "warnExpiry")
+# slot that holds each prop, timestamps are kept as-is until accessed
+USER_SLOTS = tuple(("_" + prop) if prop in USER_TIMESTAMP_PROPS else prop for prop in USER_PROPS)
+_USER_SLOT = dict(zip(USER_PROPS, USER_SLOTS))
+
+# timestamps are stored as seconds since the epoch, with our naive datetimes
+# being treated as UTC
+_EPOCH = datetime(1970, 1, 1)
+
+def _encodeTimestamp(v):
+	if isinstance(v, datetime):
+		return (v - _EPOCH) // timedelta(seconds=1)
+	return v
+
+# converts the stored value in slot `raw` to datetime on first access
+class _LazyTimestamp():
+	__slots__ = ("raw", )
+	def __init__(self, raw):
+		self.raw = raw
+	def __get__(self, obj, cls=None):
+		if obj is None:
+			return self
+		v = self.raw.__get__(obj, cls)
+		if v.__class__ is int:
+			v = _EPOCH + timedelta(seconds=v)
+			self.raw.__set__(obj, v)
+		return v
+	def __set__(self, obj, v):
+		self.raw.__set__(obj, v)
+
+# obfuscated ids change daily, `day` is the date they are valid for
+_OID_ALPHABET = "0123456789abcdefghijklmnopqrstuv"
+
+def _oidSalt(day):
+	salt = day.toordinal()
+	if salt & 0xff == 0: salt >>= 8 # zero bits are bad for hashing
+	return salt
+
+def obfuscateId(id, day):
+	value = (id * _oidSalt(day)) & 0xffffff
+	return ''.join(_OID_ALPHABET[n%32] for n in (value, value>>5, value>>10, value>>15))
+
+def _oidValue(oid):
+	# inverse of the encoding above: the low 20 bits of id * salt
+	value = 0
+	for i, c in enumerate(oid):
+		value |= _OID_ALPHABET.index(c) << (5 * i)
+	return value
+
+# groups counted by Database.getPopulation()
+POPULATION_GROUPS = ("active", "inactive", "blacklisted")
+
+def _populationGroup(rank, left):
+	if rank < 0:
+		return "blacklisted"
+	elif left is not None:
+		return "inactive"
+	return "active"
 
 class User():
-	__slots__ = USER_PROPS
+	__slots__ = USER_SLOTS + ("_snapshot", )
 	def __init__(self):
 		self.id = None # int
 		self.username = None # str?
@@ -40,12 +105,29 @@ class User():
 		self.hideKarma = None # bool
 		self.debugEnabled = None # bool
 		self.tripcode = None # str?
+		self._snapshot = None # values as of markClean()
 	def __eq__(self, other):
 		if isinstance(other, User):
 			return self.id == other.id
 		return NotImplemented
 	def __str__(self):
 		return "<User id=%d aka %r>" % (self.id, self.getFormattedName())
+	def copy(self):
+		ret = User()
+		for slot in USER_SLOTS:
+			setattr(ret, slot, getattr(self, slot))
+		return ret
+	def getEncoded(self, prop):
+		# value of `prop` as stored in the database
+		return _encodeTimestamp(getattr(self, _USER_SLOT[prop]))
+	def markClean(self):
+		self._snapshot = tuple(_encodeTimestamp(getattr(self, slot)) for slot in USER_SLOTS)
+	def getModified(self):
+		# returns the props changed since markClean() (or all if never called)
+		if self._snapshot is None:
+			return USER_PROPS
+		return tuple(prop for prop, slot, old in zip(USER_PROPS, USER_SLOTS, self._snapshot)
+			if _encodeTimestamp(getattr(self, slot)) != old)
 	def defaults(self):
 		self.rank = RANKS.user
 		self.joined = datetime.now()
@@ -55,17 +137,13 @@ class User():
 		self.hideKarma = False
 		self.debugEnabled = False
 	def isJoined(self):
-		return self.left is None
+		return self._left is None # skips timestamp conversion
 	def isInCooldown(self):
 		return self.cooldownUntil is not None and self.cooldownUntil >= datetime.now()
 	def isBlacklisted(self):
 		return self.rank < 0
 	def getObfuscatedId(self):
-		salt = date.today().toordinal()
-		if salt & 0xff == 0: salt >>= 8 # zero bits are bad for hashing
-		value = (self.id * salt) & 0xffffff
-		alpha = "0123456789abcdefghijklmnopqrstuv"
-		return ''.join(alpha[n%32] for n in (value, value>>5, value>>10, value>>15))
+		return obfuscateId(self.id, date.today())
 	def getObfuscatedKarma(self):
 		offset = round(abs(self.karma * 0.2) + 2)
 		return self.karma + randint(0, offset + 1) - offset
@@ -104,6 +182,9 @@ class User():
 		else:
 			self.warnExpiry = None
 
+for prop in USER_TIMESTAMP_PROPS:
+	setattr(User, prop, _LazyTimestamp(getattr(User, "_" + prop)))
+
 # abstract db
 
 class ModificationContext():
@@ -123,12 +204,55 @@ class ModificationContext():
 
 class Database():
 	def __init__(self):
-		self.lock = RLock()
+		self.lock = TimedLock(RLock())
+		self.population = None # dict(group -> count), see getPopulation()
 		assert self.__class__ != Database # do not instantiate directly
 	def register_tasks(self, sched):
 		raise NotImplementedError()
 	def close(self):
 		raise NotImplementedError()
+	def flush(self):
+		# returns once all previous changes are durable
+		return
+	def getStats(self):
+		return {"lock_" + k: v for k, v in self.lock.getStats().items()}
+	def getDataVersion(self):
+		# changes whenever another process modified the database, None if unsupported
+		return None
+	def _countPopulation(self):
+		d = dict.fromkeys(POPULATION_GROUPS, 0)
+		for user in self.iterateUsers():
+			d[_populationGroup(user.rank, user.left)] += 1
+		return d
+	def _updatePopulation(self, user, added=False):
+		# keeps the counters up to date, must be called on every change
+		with self.lock:
+			if self.population is None:
+				return
+			new = _populationGroup(user.rank, user.left)
+			if added:
+				self.population[new] += 1
+				return
+			if user._snapshot is None:
+				self.population = None # can't tell, recount on next access
+				return
+			old = _populationGroup(user._snapshot[USER_PROPS.index("rank")],
+				user._snapshot[USER_PROPS.index("left")])
+			if old != new:
+				self.population[old] -= 1
+				self.population[new] += 1
+	def getPopulation(self):
+		with self.lock:
+			if self.population is None:
+				self.population = self._countPopulation()
+			return self.population.copy()
+	def checkPopulation(self):
+		# recounts the population, returns the drift (actual - maintained)
+		with self.lock:
+			actual = self._countPopulation()
+			old = self.population or actual
+			self.population = actual
+		return {k: actual[k] - old[k] for k in POPULATION_GROUPS if actual[k] != old[k]}
 	def getUser(self, id=None):
 		raise NotImplementedError()
 	def setUser(self, id, user):
@@ -141,10 +265,49 @@ class Database():
 		raise NotImplementedError()
 	def setSystemConfig(self, config):
 		raise NotImplementedError()
-	def iterateUsers(self):
+	def iterateUsers(self, joined=False):
+		# `joined` skips users that aren't in the chat
+		for id in self.iterateUserIds():
+			try:
+				user = self.getUser(id=id)
+			except KeyError:
+				continue # removed in the meantime
+			if joined and not user.isJoined():
+				continue
+			yield user
+	def backup(self, dir, keep):
+		# writes a new snapshot into `dir`, returns its path or None if unsupported
+		return None
+	def archiveUsers(self, before, limit=1000):
+		# moves up to `limit` users who left before `before` out of the way of
+		# iterateUsers(), getUser() brings them back. returns their ids
+		return []
+	def getUserByName(self, username):
+		# returns the joined user with this username (case-insensitive) or None
+		username = username.lower()
+		# there *should* only be a single joined user with a given username
+		for user in self.iterateUsers(joined=True):
+			if user.username is not None and user.username.lower() == username:
+				return user
+		return None
+	def getUserByOid(self, oid):
+		# returns the joined user with today's obfuscated id `oid` or None
+		today = date.today()
+		for user in self.iterateUsers(joined=True):
+			if obfuscateId(user.id, today) == oid:
+				return user
+		return None
+	def expireWarnings(self, now):
+		# removes a warning from joined users whose warning expired
+		# returns the ids of affected users
+		ret = []
 		with self.lock:
-			l = list(self.getUser(id=id) for id in self.iterateUserIds())
-		yield from l
+			for user in self.iterateUsers(joined=True):
+				if user.warnExpiry is not None and now >= user.warnExpiry:
+					with self.modifyUser(id=user.id) as user:
+						user.removeWarning()
+					ret.append(user.id)
+		return ret
 	def modifyUser(self, **kwargs):
 		with self.lock:
 			user = self.getUser(**kwargs)
@@ -158,20 +321,35 @@ class Database():
 
 # JSON implementation
 
+# changes are appended to a journal (one JSON object per line) that is
+# periodically merged into the main file
+
 class JSONDatabase(Database):
 	def __init__(self, path):
 		super(JSONDatabase, self).__init__()
 		self.path = path
-		self.db = {"systemConfig": None, "users": []}
+		self.systemConfig = None
+		self.users = {} # dict(id -> dict)
 		try:
 			self._load()
 		except FileNotFoundError as e:
 			pass
+		self.journalSize = self._replay()
+		self.journal = open(self.path + ".journal", "a")
+		if self.journal.tell() > 0:
+			self._compact() # also gets rid of a truncated entry
+		self.population = self._countPopulation()
 		logging.warning("The JSON backend is meant for development only!")
 	def register_tasks(self, sched):
-		return
+		def f():
+			with self.lock:
+				if self.journalSize > 0:
+					self._compact()
+		sched.register(f, minutes=5)
 	def close(self):
-		return
+		with self.lock:
+			self._compact()
+			self.journal.close()
 	@staticmethod
 	def _systemConfigToDict(config):
 		return {"motd": config.motd}
@@ -183,93 +361,414 @@ class JSONDatabase(Database):
 		return config
 	@staticmethod
 	def _userToDict(user):
-		props = ["id", "username", "realname", "rank", "joined", "left",
-			"lastActive", "cooldownUntil", "blacklistReason", "warnings",
-			"warnExpiry", "karma", "hideKarma", "debugEnabled", "tripcode"]
-		d = {}
-		for prop in props:
-			value = getattr(user, prop)
-			if isinstance(value, datetime):
-				value = int(value.replace(tzinfo=timezone.utc).timestamp())
-			d[prop] = value
-		return d
+		return {prop: user.getEncoded(prop) for prop in USER_PROPS}
 	@staticmethod
 	def _userFromDict(d):
 		if d is None: return None
-		props = ["id", "username", "realname", "rank", "blacklistReason",
-			"warnings", "karma", "hideKarma", "debugEnabled"]
-		props_d = [("tripcode", None)]
-		dateprops = ["joined", "left", "lastActive", "cooldownUntil", "warnExpiry"]
 		user = User()
-		for prop in props:
-			setattr(user, prop, d[prop])
-		for prop, default in props_d:
-			setattr(user, prop, d.get(prop, default))
-		for prop in dateprops:
-			if d[prop] is not None:
-				setattr(user, prop, datetime.utcfromtimestamp(d[prop]))
+		for prop, slot in zip(USER_PROPS, USER_SLOTS):
+			setattr(user, slot, d.get(prop))
+		user.markClean()
 		return user
 	def _load(self):
 		with self.lock:
 			with open(self.path, "r") as f:
-				self.db = json.load(f)
+				d = json.load(f)
+			self.systemConfig = d["systemConfig"]
+			self.users = {u["id"]: u for u in d["users"]}
 	def _save(self):
 		with self.lock:
+			d = {"systemConfig": self.systemConfig, "users": list(self.users.values())}
 			with open(self.path + "~", "w") as f:
-				json.dump(self.db, f)
+				json.dump(d, f)
 			os.replace(self.path + "~", self.path)
+	def _apply(self, entry):
+		if "user" in entry.keys():
+			self.users[entry["user"]["id"]] = entry["user"]
+		elif "systemConfig" in entry.keys():
+			self.systemConfig = entry["systemConfig"]
+	def _replay(self):
+		n = 0
+		try:
+			with open(self.path + ".journal", "r") as f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+					except ValueError as e:
+						# last write was interrupted, everything before is fine
+						logging.warning("Ignoring truncated journal entry")
+						break
+					self._apply(entry)
+					n += 1
+		except FileNotFoundError as e:
+			pass
+		if n > 0:
+			logging.info("Replayed %d journal entries", n)
+		return n
+	def _append(self, entry):
+		self._apply(entry)
+		self.journal.write(json.dumps(entry) + "\n")
+		self.journal.flush()
+		self.journalSize += 1
+	def _compact(self):
+		# entries are idempotent, so crashing before the truncate is harmless
+		self._save()
+		self.journal.truncate(0)
+		self.journalSize = 0
 	def getUser(self, id=None):
 		if id is None:
 			raise ValueError()
 		with self.lock:
-			gen = (u for u in self.db["users"] if u["id"] == id)
-			try:
-				return JSONDatabase._userFromDict(next(gen))
-			except StopIteration as e:
+			d = self.users.get(id)
+			if d is None:
 				raise KeyError()
+			return JSONDatabase._userFromDict(d)
 	def setUser(self, id, newuser):
-		newuser = JSONDatabase._userToDict(newuser)
+		if len(newuser.getModified()) == 0:
+			return
+		d = JSONDatabase._userToDict(newuser)
 		with self.lock:
-			for i, user in enumerate(self.db["users"]):
-				if user["id"] == id:
-					self.db["users"][i] = newuser
-					self._save()
-					return
+			if id in self.users.keys():
+				self._append({"user": d})
+				self._updatePopulation(newuser)
 	def addUser(self, newuser):
-		newuser = JSONDatabase._userToDict(newuser)
+		d = JSONDatabase._userToDict(newuser)
 		with self.lock:
-			self.db["users"].append(newuser)
-			self._save()
+			self._append({"user": d})
+			self._updatePopulation(newuser, True)
 	def iterateUserIds(self):
 		with self.lock:
-			l = list(u["id"] for u in self.db["users"])
+			l = list(self.users.keys())
 		yield from l
 	def getSystemConfig(self):
 		with self.lock:
-			return JSONDatabase._systemConfigFromDict(self.db["systemConfig"])
+			return JSONDatabase._systemConfigFromDict(self.systemConfig)
 	def setSystemConfig(self, config):
 		with self.lock:
-			self.db["systemConfig"] = JSONDatabase._systemConfigToDict(config)
-			self._save()
+			self._append({"systemConfig": JSONDatabase._systemConfigToDict(config)})
 
 # SQLite implementation
 
+# changes to these props are frequent and of low value, so they are buffered
+# in memory and written in bulk (see SQLiteDatabase._flushPending)
+WRITE_BEHIND_PROPS = ("lastActive", "karma")
+
+# columns in the same order as USER_PROPS, so rows can be decoded positionally
+USER_COLUMNS = ", ".join("`%s`" % prop for prop in USER_PROPS)
+_USER_SETTERS = tuple(getattr(User, slot).__set__ for slot in USER_SLOTS)
+
+USERS_TABLE = """
+CREATE TABLE IF NOT EXISTS `%s` (
+	`id` BIGINT NOT NULL,
+	`username` TEXT,
+	`realname` TEXT NOT NULL,
+	`rank` INTEGER NOT NULL,
+	`joined` INTEGER NOT NULL,
+	`left` INTEGER,
+	`lastActive` INTEGER NOT NULL,
+	`cooldownUntil` INTEGER,
+	`blacklistReason` TEXT,
+	`warnings` INTEGER NOT NULL,
+	`warnExpiry` INTEGER,
+	`karma` INTEGER NOT NULL,
+	`hideKarma` TINYINT NOT NULL,
+	`debugEnabled` TINYINT NOT NULL,
+	`tripcode` TEXT,
+	PRIMARY KEY (`id`)
+);
+""".strip()
+
+# online backups
+
+def backupSQLite(path, dest, pages=256, pause=0.01):
+	# copies the database at `path` into the file `dest` while it is in use.
+	# a read transaction is held on the source so that writes made meanwhile
+	# don't restart the copy. between steps of `pages` pages the other threads
+	# get `pause` seconds to do their work
+	src = sqlite3.connect(path, isolation_level=None)
+	dst = sqlite3.connect(dest)
+	try:
+		src.execute("BEGIN")
+		src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+		src.backup(dst, pages=pages, progress=lambda *_: time.sleep(pause))
+		src.execute("COMMIT")
+	finally:
+		dst.close()
+		src.close()
+
+def rotateBackups(path, dir, keep, **kwargs):
+	# backs up `path` into a new timestamped file in `dir` and deletes all but
+	# the `keep` newest ones. returns the path of the new file
+	os.makedirs(dir, exist_ok=True)
+	name = "backup-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".sqlite"
+	dest = os.path.join(dir, name)
+	backupSQLite(path, dest + ".tmp", **kwargs)
+	os.replace(dest + ".tmp", dest)
+	l = sorted(f for f in os.listdir(dir) if f.startswith("backup-") and f.endswith(".sqlite"))
+	for f in l[:-keep]:
+		os.remove(os.path.join(dir, f))
+	return dest
+
+# queued operation for the writer thread
+class _WriteOp():
+	__slots__ = ("func", "done", "result", "exc", "queued")
+	def __init__(self, func, wait):
+		self.func = func
+		self.done = Event() if wait else None
+		self.result = None
+		self.exc = None
+		self.queued = time.monotonic()
+
 class SQLiteDatabase(Database):
-	def __init__(self, path):
+	# `commit_policy` enables a thread that applies writes in batches:
+	#   ("latency", ms): commit at most ms milliseconds after a write
+	#   ("count", n): commit every n writes, or at least once per second
+	# `maintenance_hour` is the hour of the day maintenance() runs at
+	def __init__(self, path, readers=2, commit_policy=None, maintenance_hour=4):
 		super(SQLiteDatabase, self).__init__()
-		self.db = sqlite3.connect(path, check_same_thread=False,
-			detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-		self.db.row_factory = sqlite3.Row
+		self.path = path
+		# all writes go through this connection via _write().
+		# it is in autocommit mode, multiple statements use _transaction()
+		self.db = self._connect()
+		# read-only connections, these never need to wait for the writer
+		self.readers = Queue()
+		self.readersLock = Lock() # protects readersLeft
+		self.readersLeft = readers # how many more may be opened
+		self.readerWaits = 0
+		self.update_sql = {} # dict(tuple of props -> UPDATE statement)
+		self.pending = {} # dict(id -> dict(prop -> value)), not yet written
+		self.maintenanceHour = maintenance_hour
+		self.lastMaintenance = None
+		self.maintenanceStats = dict.fromkeys(("runs", "last_ms", "last_step_max_ms"), 0)
+		# writer thread
+		self.writer = None
+		self.writerLock = Lock() # protects the two counters below
+		self.submitted = 0
+		self.committed = 0
+		self.writerStats = dict.fromkeys(("batches", "ops", "batch_max",
+			"commit_total_ms", "commit_max_ms", "latency_max_ms"), 0)
 		self._ensure_schema()
+		self.population = self._countPopulation()
+		if commit_policy is not None:
+			kind, value = commit_policy
+			if kind == "latency":
+				self.batchSize, self.batchDelay = float("inf"), value / 1000
+			elif kind == "count":
+				self.batchSize, self.batchDelay = value, 1.0
+			else:
+				raise ValueError("unknown commit policy %r" % kind)
+			self.queue = Queue()
+			self.writer = Thread(target=self._writerThread, name="db-writer", daemon=True)
+			self.writer.start()
+	def _connect(self):
+		conn = sqlite3.connect(self.path, check_same_thread=False,
+			isolation_level=None)
+		# in WAL mode this is still safe from corruption, only a power loss
+		# may roll back the most recent transactions
+		conn.execute("PRAGMA synchronous = NORMAL")
+		return conn
+	@contextmanager
+	def _reader(self):
+		try:
+			conn = self.readers.get(False)
+		except Empty:
+			conn = None
+		if conn is None:
+			with self.readersLock:
+				if self.readersLeft > 0:
+					self.readersLeft -= 1
+					conn = self._connect()
+					conn.execute("PRAGMA query_only = ON")
+			if conn is None:
+				self.readerWaits += 1
+				conn = self.readers.get()
+		try:
+			yield conn
+		finally:
+			self.readers.put(conn)
+	@contextmanager
+	def _transaction(self):
+		if current_thread() is self.writer:
+			yield # already part of a batch
+			return
+		with self.lock:
+			self.db.execute("BEGIN")
+			try:
+				yield
+			except:
+				self.db.execute("ROLLBACK")
+				raise
+			self.db.execute("COMMIT")
+	def _write(self, func, wait=False):
+		# runs func() with the writer connection, either directly or in the
+		# writer thread. returns its result only if wait=True
+		if self.writer is None:
+			with self.lock:
+				return func()
+		op = _WriteOp(func, wait)
+		with self.writerLock:
+			self.submitted += 1
+			self.queue.put(op)
+		if wait:
+			op.done.wait()
+			if op.exc is not None:
+				raise op.exc
+			return op.result
+	def _sync(self):
+		# wait until readers can see all previous writes, a waiting
+		# operation also makes the writer commit immediately
+		if self.writer is not None and self.submitted > self.committed:
+			self._write(lambda: None, wait=True)
+	def _writerThread(self):
+		while True:
+			op = self.queue.get()
+			if op is None:
+				break
+			batch = [op]
+			deadline = time.monotonic() + self.batchDelay
+			# someone waiting on the result ends the batch early
+			while len(batch) < self.batchSize and op.done is None:
+				timeout = deadline - time.monotonic()
+				if timeout <= 0:
+					break
+				try:
+					op = self.queue.get(timeout=timeout)
+				except Empty:
+					break
+				if op is None:
+					self.queue.put(None) # exit after this batch
+					break
+				batch.append(op)
+			self._runBatch(batch)
+	def _runBatch(self, batch):
+		t = time.monotonic()
+		try:
+			self.db.execute("BEGIN")
+			for op in batch:
+				self.db.execute("SAVEPOINT op")
+				try:
+					op.result = op.func()
+				except Exception as e:
+					logging.exception("Exception raised during database write")
+					op.exc = e
+					self.db.execute("ROLLBACK TO op")
+				self.db.execute("RELEASE op")
+			self.db.execute("COMMIT")
+		except Exception as e:
+			logging.exception("Failed to commit %d database writes", len(batch))
+			if self.db.in_transaction:
+				self.db.execute("ROLLBACK")
+			for op in batch:
+				op.exc = op.exc or e
+		now = time.monotonic()
+		st = self.writerStats
+		st["batches"] += 1
+		st["ops"] += len(batch)
+		st["batch_max"] = max(st["batch_max"], len(batch))
+		st["commit_total_ms"] += round((now - t) * 1000)
+		st["commit_max_ms"] = max(st["commit_max_ms"], round((now - t) * 1000))
+		st["latency_max_ms"] = max(st["latency_max_ms"], round((now - batch[0].queued) * 1000))
+		with self.writerLock:
+			self.committed += len(batch)
+		for op in batch:
+			if op.done is not None:
+				op.done.set()
 	def register_tasks(self, sched):
 		def f():
 			with self.lock:
-				self.db.commit()
+				self._flushPending()
 		sched.register(f, seconds=5)
+		def f():
+			now = datetime.now()
+			if now.hour != self.maintenanceHour:
+				return
+			if self.lastMaintenance is not None and now - self.lastMaintenance < timedelta(hours=12):
+				return
+			self.lastMaintenance = now
+			self.maintenance()
+		sched.register(f, minutes=10)
+	def _walSize(self):
+		try:
+			return os.path.getsize(self.path + "-wal")
+		except FileNotFoundError as e:
+			return 0
+	def maintenance(self, limit=5.0, pages=256):
+		# updates query planner statistics, frees unused pages and checkpoints
+		# the WAL. every step is short so other writes never wait for long,
+		# vacuuming stops after `limit` seconds and continues next time
+		t = time.monotonic()
+		longest = 0
+		def step(f):
+			nonlocal longest
+			t = time.monotonic()
+			ret = self._write(f, wait=True)
+			longest = max(longest, time.monotonic() - t)
+			return ret
+		pragma = lambda name: self.db.execute("PRAGMA " + name).fetchone()[0]
+		walBefore = self._walSize()
+		with self.lock:
+			self._flushPending()
+		def f():
+			self.db.execute("PRAGMA analysis_limit = 1000")
+			self.db.execute("ANALYZE")
+			self.db.execute("PRAGMA optimize")
+		step(f)
+		free = step(lambda: pragma("freelist_count"))
+		freed = 0
+		if step(lambda: pragma("auto_vacuum")) == 2: # incremental
+			def f():
+				self.db.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+				return pragma("freelist_count")
+			while free > 0 and time.monotonic() - t < limit:
+				left = step(f)
+				freed += free - left
+				free = left
+		# doesn't need the write lock, only shrink the WAL if that's quick
+		conn = self._connect()
+		try:
+			_, frames, done = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+			if frames == done:
+				conn.execute("PRAGMA busy_timeout = 100")
+				conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+		finally:
+			conn.close()
+		t = time.monotonic() - t
+		st = self.maintenanceStats
+		st["runs"] += 1
+		st["last_ms"] = round(t * 1000)
+		st["last_step_max_ms"] = round(longest * 1000)
+		logging.info("Database maintenance took %.1fs (longest step %dms): freed %d pages, "
+			"%d free pages left, WAL %d -> %d KiB", t, longest * 1000, freed, free,
+			walBefore // 1024, self._walSize() // 1024)
 	def close(self):
 		with self.lock:
-			self.db.commit()
+			self._flushPending()
+			if self.writer is not None:
+				self.queue.put(None)
+				self.writer.join()
 			self.db.close()
+			while not self.readers.empty():
+				self.readers.get().close()
+	def flush(self):
+		with self.lock:
+			self._flushPending()
+		self._sync()
+	def backup(self, dir, keep):
+		self.flush() # include buffered changes
+		t = time.monotonic()
+		path = rotateBackups(self.path, dir, keep)
+		logging.info("Database backed up to %s in %.1fs (%d KiB)", path,
+			time.monotonic() - t, os.path.getsize(path) // 1024)
+		return path
+	def getStats(self):
+		d = super(SQLiteDatabase, self).getStats()
+		d["reader_waits"] = self.readerWaits
+		d["pending_users"] = len(self.pending)
+		d.update(("maintenance_" + k, v) for k, v in self.maintenanceStats.items())
+		if self.writer is not None:
+			d.update(("writer_" + k, v) for k, v in self.writerStats.items())
+			d["writer_queued"] = self.submitted - self.committed
+		return d
 	@staticmethod
 	def _systemConfigToDict(config):
 		return {"motd": config.motd}
@@ -281,19 +780,63 @@ class SQLiteDatabase(Database):
 		return config
 	@staticmethod
 	def _userToDict(user):
-		return {prop: getattr(user, prop) for prop in USER_PROPS}
+		return {prop: user.getEncoded(prop) for prop in USER_PROPS}
 	@staticmethod
 	def _userFromRow(r):
-		user = User()
-		for prop in r.keys():
-			setattr(user, prop, r[prop])
+		# `r` is a row of USER_COLUMNS. this is the hottest path when loading
+		# users, so it avoids anything that isn't strictly necessary
+		user = User.__new__(User)
+		for f, v in zip(_USER_SETTERS, r):
+			f(user, v)
+		user._snapshot = r
 		return user
-	def _ensure_schema(self):
-		def row_exists(table, name):
-			cur = self.db.execute("PRAGMA table_info(`" + table + "`);")
-			return any(row[1] == name for row in cur)
+	# migrations, the n-th entry upgrades the schema to version n (user_version).
+	# earlier ones are written to also cope with databases from before this
+	# list existed
+	def _migrate_tripcode(self):
+		cur = self.db.execute("PRAGMA table_info(`users`)")
+		if not any(row[1] == "tripcode" for row in cur):
+			self.db.execute("ALTER TABLE `users` ADD `tripcode` TEXT")
+	def _migrate_timestamps(self):
+		# timestamps used to be stored as text, convert them to epoch seconds.
+		# sqlite can't change column types so the table is rebuilt
+		cur = self.db.execute("PRAGMA table_info(`users`)")
+		if dict((row[1], row[2]) for row in cur)["joined"] != "TIMESTAMP":
+			return
+		logging.info("Converting timestamps in database, this may take a moment")
+		cols = ", ".join(
+			("CAST(strftime('%%s', `%s`) AS INTEGER)" % prop) if prop in USER_TIMESTAMP_PROPS
+			else ("`%s`" % prop) for prop in USER_PROPS)
+		self.db.execute(USERS_TABLE % "users_new")
+		self.db.execute("INSERT INTO `users_new` (" + USER_COLUMNS + ") SELECT " + cols + " FROM `users`")
+		self.db.execute("DROP TABLE `users`")
+		self.db.execute("ALTER TABLE `users_new` RENAME TO `users`")
+	def _migrate_indexes(self):
+		# getUserByName, util/perms.py and util/blacklist.py sync, joined users,
+		# warning expiry
+		self.db.execute("CREATE INDEX IF NOT EXISTS `users_username` ON `users` (lower(`username`))")
+		self.db.execute("CREATE INDEX IF NOT EXISTS `users_rank_left` ON `users` (`rank`, `left`)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS `users_left` ON `users` (`left`)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS `users_warnExpiry` ON `users` (`warnExpiry`)")
+	def _migrate_archive(self):
+		# users that left long ago, see archiveUsers()
+		self.db.execute(USERS_TABLE % "users_archive")
+		self.db.execute("CREATE INDEX IF NOT EXISTS `users_archive_username` ON `users_archive` (lower(`username`))")
+		# for util/ scripts that need to see everyone
+		self.db.execute("CREATE VIEW IF NOT EXISTS `all_users` AS SELECT * FROM `users` UNION ALL SELECT * FROM `users_archive`")
+	MIGRATIONS = (_migrate_tripcode, _migrate_timestamps, _migrate_indexes, _migrate_archive)
 
+	def _ensure_schema(self):
 		with self.lock:
+			# lets maintenance() free unused pages in small steps. this only
+			# works on a new database before WAL mode is enabled, otherwise
+			# needs a VACUUM
+			if self.db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+				self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+				if self.db.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] > 0:
+					logging.info("Enabling incremental vacuum, this may take a moment")
+					self.db.execute("VACUUM")
+			self.db.execute("PRAGMA journal_mode = WAL")
 			# create initial schema
 			self.db.execute("""
 CREATE TABLE IF NOT EXISTS `system_config` (
@@ -302,80 +845,661 @@ CREATE TABLE IF NOT EXISTS `system_config` (
 	PRIMARY KEY (`name`)
 );
 			""".strip())
-			self.db.execute("""
-CREATE TABLE IF NOT EXISTS `users` (
-	`id` BIGINT NOT NULL,
-	`username` TEXT,
-	`realname` TEXT NOT NULL,
-	`rank` INTEGER NOT NULL,
-	`joined` TIMESTAMP NOT NULL,
-	`left` TIMESTAMP,
-	`lastActive` TIMESTAMP NOT NULL,
-	`cooldownUntil` TIMESTAMP,
-	`blacklistReason` TEXT,
-	`warnings` INTEGER NOT NULL,
-	`warnExpiry` TIMESTAMP,
-	`karma` INTEGER NOT NULL,
-	`hideKarma` TINYINT NOT NULL,
-	`debugEnabled` TINYINT NOT NULL,
-	`tripcode` TEXT,
-	PRIMARY KEY (`id`)
-);
-			""".strip())
+			self.db.execute(USERS_TABLE % "users")
 			# migration
-			if not row_exists("users", "tripcode"):
-				self.db.execute("ALTER TABLE `users` ADD `tripcode` TEXT")
+			version = self.db.execute("PRAGMA user_version").fetchone()[0]
+			if version > len(self.MIGRATIONS):
+				raise RuntimeError("Database schema is newer than this version of the bot")
+			if version == len(self.MIGRATIONS):
+				return
+			for i in range(version, len(self.MIGRATIONS)):
+				logging.info("Migrating database schema to version %d", i + 1)
+				with self._transaction():
+					self.MIGRATIONS[i](self)
+					self.db.execute("PRAGMA user_version = %d" % (i + 1))
+			# update query planner statistics
+			self.db.execute("ANALYZE")
 	def getUser(self, id=None):
 		if id is None:
 			raise ValueError()
-		sql = "SELECT * FROM users WHERE id = ?"
+		sql = "SELECT " + USER_COLUMNS + " FROM users WHERE id = ?"
 		param = id
-		with self.lock:
-			cur = self.db.execute(sql, (param, ))
+		self._sync()
+		with self._reader() as conn:
+			cur = conn.execute(sql, (param, ))
 			row = cur.fetchone()
+			if row is None:
+				cur = conn.execute("SELECT 1 FROM users_archive WHERE id = ?", (param, ))
+				archived = cur.fetchone() is not None
 		if row is None:
-			raise KeyError()
-		return SQLiteDatabase._userFromRow(row)
+			if not archived:
+				raise KeyError()
+			self._unarchiveUser(id)
+			return self.getUser(id=id)
+		return self._applyPending(SQLiteDatabase._userFromRow(row))
+	def _unarchiveUser(self, id):
+		sql = "INSERT OR IGNORE INTO users (" + USER_COLUMNS + ") SELECT " + USER_COLUMNS
+		sql += " FROM users_archive WHERE id = ?"
+		def f():
+			with self._transaction():
+				self.db.execute(sql, (id, ))
+				self.db.execute("DELETE FROM users_archive WHERE id = ?", (id, ))
+		# someone else might have done this already, in which case nothing happens
+		self._write(f, wait=True)
+		logging.debug("Restored user %d from archive", id)
+	def archiveUsers(self, before, limit=1000):
+		select = "SELECT `id` FROM users WHERE `left` < ? LIMIT ?"
+		sql = "INSERT INTO users_archive (" + USER_COLUMNS + ") SELECT " + USER_COLUMNS
+		sql += " FROM users WHERE id = ?"
+		before = _encodeTimestamp(before)
+		def f():
+			with self._transaction():
+				ret = list(row[0] for row in self.db.execute(select, (before, limit)))
+				self.db.executemany(sql, ((id, ) for id in ret))
+				self.db.executemany("DELETE FROM users WHERE id = ?", ((id, ) for id in ret))
+			return ret
+		with self.lock:
+			# buffered values would get lost otherwise
+			self._flushPending()
+			return self._write(f, wait=True)
+	def _getUpdateSql(self, props):
+		sql = self.update_sql.get(props)
+		if sql is None:
+			# only a handful of combinations occur in practice, so the statement
+			# cache of the sqlite module will reuse these
+			sql = "UPDATE users SET "
+			sql += ", ".join("`%s` = ?" % k for k in props)
+			sql += " WHERE id = ?"
+			self.update_sql[props] = sql
+		return sql
+	def _applyPending(self, user):
+		d = self.pending.get(user.id)
+		if d is not None:
+			for prop, value in d.items():
+				setattr(user, _USER_SLOT[prop], value)
+			user.markClean()
+		return user
+	def _flushPending(self):
+		if len(self.pending) == 0:
+			return
+		groups = {} # dict(tuple of props -> list of params)
+		for id, d in self.pending.items():
+			props = tuple(prop for prop in WRITE_BEHIND_PROPS if prop in d.keys())
+			param = list(d[prop] for prop in props) + [id, ]
+			groups.setdefault(props, []).append(param)
+		def f():
+			with self._transaction():
+				for props, l in groups.items():
+					self.db.executemany(self._getUpdateSql(props), l)
+		self._write(f, wait=True)
+		# only clear this after commit so readers don't see outdated values
+		self.pending = {}
+		logging.debug("Flushed buffered changes of %d users", sum(len(l) for l in groups.values()))
 	def setUser(self, id, newuser):
-		newuser = SQLiteDatabase._userToDict(newuser)
-		del newuser['id'] # this is our primary key
-		sql = "UPDATE users SET "
-		sql += ", ".join("`%s` = ?" % k for k in newuser.keys())
-		sql += " WHERE id = ?"
-		param = list(newuser.values()) + [id, ]
-		with self.lock:
-			self.db.execute(sql, param)
+		props = tuple(prop for prop in newuser.getModified() if prop != "id")
+		if len(props) == 0:
+			return
+		with self.lock:
+			if all(prop in WRITE_BEHIND_PROPS for prop in props):
+				d = self.pending.setdefault(id, {})
+				for prop in props:
+					d[prop] = newuser.getEncoded(prop)
+				return
+			# write buffered values along with the others
+			d = self.pending.pop(id, None)
+			if d is not None:
+				props += tuple(prop for prop in d.keys() if prop not in props)
+			sql = self._getUpdateSql(props)
+			param = list(newuser.getEncoded(prop) for prop in props) + [id, ]
+			self._write(lambda: self.db.execute(sql, param))
+			self._updatePopulation(newuser)
 	def addUser(self, newuser):
-		newuser = SQLiteDatabase._userToDict(newuser)
+		d = SQLiteDatabase._userToDict(newuser)
 		sql = "INSERT INTO users("
-		sql += ", ".join("`%s`" % k for k in newuser.keys())
+		sql += ", ".join("`%s`" % k for k in d.keys())
 		sql += ") VALUES ("
-		sql += ", ".join("?" for i in range(len(newuser)))
+		sql += ", ".join("?" for i in range(len(d)))
 		sql += ")"
-		param = list(newuser.values())
+		param = list(d.values())
 		with self.lock:
-			self.db.execute(sql, param)
+			self._write(lambda: self.db.execute(sql, param))
+			self._updatePopulation(newuser, True)
+	def getDataVersion(self):
+		f = lambda: self.db.execute("PRAGMA data_version").fetchone()[0]
+		return self._write(f, wait=True)
+	def _iterateRows(self, columns, where=None, chunk=1000):
+		# pages through users by id so only `chunk` rows are held in memory at
+		# once and a reader connection is only taken while fetching them.
+		# the first column must be `id`
+		sql = "SELECT " + columns + " FROM users WHERE `id` > ?"
+		if where is not None:
+			sql += " AND " + where
+		sql += " ORDER BY `id` LIMIT %d" % chunk
+		last = -(1 << 63)
+		self._sync()
+		while True:
+			with self._reader() as conn:
+				rows = conn.execute(sql, (last, )).fetchall()
+			yield from rows
+			if len(rows) < chunk:
+				break
+			last = rows[-1][0]
 	def iterateUserIds(self):
-		sql = "SELECT `id` FROM users"
-		with self.lock:
-			cur = self.db.execute(sql)
-			l = cur.fetchall()
-		yield from l
-	def iterateUsers(self):
-		sql = "SELECT * FROM users"
+		for row in self._iterateRows("`id`"):
+			yield row[0]
+	def iterateUsers(self, joined=False):
+		where = "`left` IS NULL" if joined else None
+		for row in self._iterateRows(USER_COLUMNS, where):
+			yield self._applyPending(SQLiteDatabase._userFromRow(row))
+	def getUserByName(self, username):
+		# uses the users_username index
+		sql = "SELECT " + USER_COLUMNS + " FROM users "
+		sql += "WHERE lower(`username`) = ? AND `left` IS NULL LIMIT 1"
+		self._sync()
+		with self._reader() as conn:
+			row = conn.execute(sql, (username.lower(), )).fetchone()
+		if row is None:
+			return None
+		return self._applyPending(SQLiteDatabase._userFromRow(row))
+	def getUserByOid(self, oid):
+		if len(oid) != 4 or any(c not in _OID_ALPHABET for c in oid):
+			return None
+		# still a scan, but without decoding every row in Python
+		sql = "SELECT " + USER_COLUMNS + " FROM users "
+		sql += "WHERE `left` IS NULL AND (`id` * ?) & 1048575 = ? LIMIT 1"
+		param = (_oidSalt(date.today()), _oidValue(oid))
+		self._sync()
+		with self._reader() as conn:
+			row = conn.execute(sql, param).fetchone()
+		if row is None:
+			return None
+		return self._applyPending(SQLiteDatabase._userFromRow(row))
+	def expireWarnings(self, now):
+		# same as User.removeWarning() but for all due users at once
+		where = "WHERE `warnExpiry` <= ? AND `left` IS NULL"
+		sql = "UPDATE users SET `warnings` = max(`warnings` - 1, 0), "
+		sql += "`warnExpiry` = CASE WHEN `warnings` > 1 THEN ? ELSE NULL END "
+		sql += where
+		expiry = _encodeTimestamp(now + timedelta(hours=WARN_EXPIRE_HOURS))
+		now = _encodeTimestamp(now)
+		def f():
+			with self._transaction():
+				cur = self.db.execute("SELECT `id` FROM users " + where, (now, ))
+				ret = list(row[0] for row in cur)
+				if len(ret) > 0:
+					self.db.execute(sql, (expiry, now))
+			return ret
+		# keeps this from landing between the read and write of modifyUser()
 		with self.lock:
-			cur = self.db.execute(sql)
-			l = list(SQLiteDatabase._userFromRow(row) for row in cur)
-		yield from l
+			# buffered values would overwrite the result otherwise
+			self._flushPending()
+			return self._write(f, wait=True)
+	def _countPopulation(self):
+		sql = "SELECT CASE WHEN `rank` < 0 THEN 'blacklisted' "
+		sql += "WHEN `left` IS NOT NULL THEN 'inactive' ELSE 'active' END AS g, "
+		sql += "COUNT(*) FROM all_users GROUP BY g"
+		d = dict.fromkeys(POPULATION_GROUPS, 0)
+		self._sync()
+		with self._reader() as conn:
+			for row in conn.execute(sql):
+				d[row[0]] = row[1]
+		return d
 	def getSystemConfig(self):
-		sql = "SELECT * FROM system_config"
-		with self.lock:
-			cur = self.db.execute(sql)
-			d = {row['name']: row['value'] for row in cur}
+		sql = "SELECT `name`, `value` FROM system_config"
+		self._sync()
+		with self._reader() as conn:
+			cur = conn.execute(sql)
+			d = {row[0]: row[1] for row in cur}
 		return SQLiteDatabase._systemConfigFromDict(d)
 	def setSystemConfig(self, config):
 		d = SQLiteDatabase._systemConfigToDict(config)
 		sql = "REPLACE INTO system_config(`name`, `value`) VALUES (?, ?)"
+		def f():
+			with self._transaction():
+				for k, v in d.items():
+					self.db.execute(sql, (k, v))
+		self._write(f)
+
+# Log implementation
+
+# every change appends the complete record to a binary log file that is
+# memory-mapped for reading. which record is the latest one for each user is
+# kept in an index built when opening, the file is rewritten once most of it
+# is outdated
+
+_LOG_MAGIC = b"SLNGLOG\x01"
+_LOG_RECORD = struct.Struct("<IIB") # payload length, crc32 of payload, type
+_LOG_USER = 1
+_LOG_SYSTEM_CONFIG = 2
+# a user record starts with a bitmask of props that are None (bit n is
+# USER_PROPS[n]) followed by the numeric props, then the strings prefixed by
+# their length. `id` has to come first
+_LOG_FIXED_PROPS = ("id", "rank", "joined", "left", "lastActive", "cooldownUntil",
+	"warnings", "warnExpiry", "karma", "hideKarma", "debugEnabled")
+_LOG_STRING_PROPS = ("username", "realname", "blacklistReason", "tripcode")
+_LOG_FIXED = struct.Struct("<HqiqqqqiqiBB")
+_LOG_ID = struct.Struct("<Hq")
+_LOG_STRLEN = struct.Struct("<H")
+_LOG_FIXED_IDX = tuple(USER_PROPS.index(prop) for prop in _LOG_FIXED_PROPS)
+_LOG_STRING_IDX = tuple(USER_PROPS.index(prop) for prop in _LOG_STRING_PROPS)
+_LOG_BOOL_IDX = (USER_PROPS.index("hideKarma"), USER_PROPS.index("debugEnabled"))
+_LOG_LEFT_BIT = 1 << USER_PROPS.index("left")
+_LOG_WARN_EXPIRY_BIT = 1 << USER_PROPS.index("warnExpiry")
+
+def _logEncodeUser(user):
+	v = tuple(user.getEncoded(prop) for prop in USER_PROPS)
+	mask = 0
+	for i, x in enumerate(v):
+		if x is None:
+			mask |= 1 << i
+	l = [_LOG_FIXED.pack(mask, *(v[i] or 0 for i in _LOG_FIXED_IDX))]
+	for i in _LOG_STRING_IDX:
+		b = (v[i] or "").encode("utf-8")
+		l.append(_LOG_STRLEN.pack(len(b)))
+		l.append(b)
+	return b"".join(l)
+
+def _logDecodeUser(buf, pos):
+	# returns a row like the SQLite backend uses
+	row = [None] * len(USER_PROPS)
+	fixed = _LOG_FIXED.unpack_from(buf, pos)
+	for i, v in zip(_LOG_FIXED_IDX, fixed[1:]):
+		row[i] = v
+	pos += _LOG_FIXED.size
+	for i in _LOG_STRING_IDX:
+		n = _LOG_STRLEN.unpack_from(buf, pos)[0]
+		pos += _LOG_STRLEN.size
+		row[i] = str(buf[pos:pos+n], "utf-8")
+		pos += n
+	for i in _LOG_BOOL_IDX:
+		row[i] = bool(row[i])
+	mask = fixed[0]
+	if mask != 0:
+		for i in range(len(row)):
+			if mask >> i & 1:
+				row[i] = None
+	return tuple(row)
+
+class LogDatabase(Database):
+	def __init__(self, path):
+		super(LogDatabase, self).__init__()
+		self.path = path
+		self.users = {} # dict(id -> (offset, length)) of the latest record
+		self.systemConfig = None # (offset, length)
+		self.deadBytes = 0 # size of outdated records
+		self.compactions = 0
+		# no warning expires before this (encoded), None if unknown
+		self.nextWarnExpiry = None
+		self.mm = None
+		self.f = open(path, "a+b")
+		if self.f.tell() == 0:
+			self.f.write(_LOG_MAGIC)
+			self.f.flush()
+		self.size = self.f.tell()
+		self._map()
+		self._scan()
+		self.population = self._countPopulation()
+	def register_tasks(self, sched):
+		def f():
+			with self.lock:
+				if self.deadBytes > max(self.size // 2, 1 << 20):
+					self._compact()
+		sched.register(f, minutes=5)
+	def close(self):
+		with self.lock:
+			if self.deadBytes > 0:
+				self._compact()
+			self.mm.close()
+			self.f.close()
+	def flush(self):
+		with self.lock:
+			os.fsync(self.f.fileno())
+	def getStats(self):
+		d = super(LogDatabase, self).getStats()
+		d["log_bytes"] = self.size
+		d["log_dead_bytes"] = self.deadBytes
+		d["log_compactions"] = self.compactions
+		return d
+	def _map(self):
+		if self.mm is not None:
+			self.mm.close()
+		self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+	def _buf(self):
+		# the mapping has to be renewed to see records appended since
+		if len(self.mm) < self.size:
+			self._map()
+		return self.mm
+	def _scan(self):
+		buf = self.mm
+		if buf[:len(_LOG_MAGIC)] != _LOG_MAGIC:
+			raise ValueError("%s is not a log database" % self.path)
+		pos, n = len(_LOG_MAGIC), 0
+		while pos + _LOG_RECORD.size <= self.size:
+			length, crc, type = _LOG_RECORD.unpack_from(buf, pos)
+			start = pos + _LOG_RECORD.size
+			if start + length > self.size or zlib.crc32(buf[start:start+length]) != crc:
+				break
+			id = _LOG_ID.unpack_from(buf, start)[1] if type == _LOG_USER else None
+			self._indexRecord(type, id, start, length)
+			pos = start + length
+			n += 1
+		if pos < self.size:
+			# last write was interrupted, everything before is fine
+			logging.warning("Ignoring truncated record at the end of the log")
+			self.mm.close()
+			self.mm = None
+			self.f.truncate(pos)
+			self.size = pos
+			self._map()
+		if n > 0:
+			logging.info("Read %d log records (%d KiB)", n, self.size // 1024)
+	def _countPopulation(self):
+		# only needs the fixed part of each record
+		i, j = _LOG_FIXED_PROPS.index("rank") + 1, _LOG_FIXED_PROPS.index("left") + 1
+		d = dict.fromkeys(POPULATION_GROUPS, 0)
+		with self.lock:
+			buf = self._buf()
+			for offset, _ in self.users.values():
+				fixed = _LOG_FIXED.unpack_from(buf, offset)
+				left = None if fixed[0] & _LOG_LEFT_BIT else fixed[j]
+				d[_populationGroup(fixed[i], left)] += 1
+		return d
+	def _indexRecord(self, type, id, offset, length):
+		if type == _LOG_USER:
+			old = self.users.get(id)
+			self.users[id] = (offset, length)
+		elif type == _LOG_SYSTEM_CONFIG:
+			old = self.systemConfig
+			self.systemConfig = (offset, length)
+		else:
+			raise ValueError("unknown record type %d" % type)
+		if old is not None:
+			self.deadBytes += _LOG_RECORD.size + old[1]
+	def _append(self, type, id, payload):
+		rec = _LOG_RECORD.pack(len(payload), zlib.crc32(payload), type) + payload
+		self.f.write(rec)
+		self.f.flush()
+		self._indexRecord(type, id, self.size + _LOG_RECORD.size, len(payload))
+		self.size += len(rec)
+	def _compact(self):
+		# copies the latest records into a new file
+		buf = self._buf()
+		users, pos = {}, len(_LOG_MAGIC)
+		with open(self.path + "~", "wb") as f:
+			f.write(_LOG_MAGIC)
+			def copy(e):
+				nonlocal pos
+				f.write(buf[e[0] - _LOG_RECORD.size:e[0] + e[1]])
+				pos += _LOG_RECORD.size + e[1]
+				return (pos - e[1], e[1])
+			for id, e in self.users.items():
+				users[id] = copy(e)
+			systemConfig = None if self.systemConfig is None else copy(self.systemConfig)
+			f.flush()
+			os.fsync(f.fileno())
+		self.mm.close()
+		self.mm = None
+		self.f.close()
+		os.replace(self.path + "~", self.path)
+		logging.debug("Compacted log from %d to %d bytes", self.size, pos)
+		self.f = open(self.path, "a+b")
+		self.users, self.systemConfig = users, systemConfig
+		self.size, self.deadBytes = pos, 0
+		self.compactions += 1
+		self._map()
+	def _getUser(self, id):
+		e = self.users.get(id)
+		if e is None:
+			return None
+		return SQLiteDatabase._userFromRow(_logDecodeUser(self._buf(), e[0]))
+	def getUser(self, id=None):
+		if id is None:
+			raise ValueError()
+		with self.lock:
+			user = self._getUser(id)
+		if user is None:
+			raise KeyError()
+		return user
+	def setUser(self, id, newuser):
+		if len(newuser.getModified()) == 0:
+			return
+		payload = _logEncodeUser(newuser)
+		with self.lock:
+			if id in self.users.keys():
+				self._append(_LOG_USER, id, payload)
+				self._updatePopulation(newuser)
+				self._noteWarnExpiry(newuser)
+	def addUser(self, newuser):
+		payload = _logEncodeUser(newuser)
 		with self.lock:
-			for k, v in d.items():
-				self.db.execute(sql, (k, v))
+			self._append(_LOG_USER, newuser.id, payload)
+			self._updatePopulation(newuser, True)
+			self._noteWarnExpiry(newuser)
+	def _noteWarnExpiry(self, user):
+		if user.warnExpiry is not None and self.nextWarnExpiry is not None:
+			self.nextWarnExpiry = min(self.nextWarnExpiry, _encodeTimestamp(user.warnExpiry))
+	def expireWarnings(self, now):
+		# only needs the fixed part of each record, and nothing at all while
+		# no warning is due
+		now = _encodeTimestamp(now)
+		if self.nextWarnExpiry is not None and now < self.nextWarnExpiry:
+			return []
+		k = _LOG_FIXED_PROPS.index("warnExpiry") + 1
+		ret = []
+		with self.lock:
+			buf = self._buf()
+			earliest = None
+			for id, (offset, _) in self.users.items():
+				fixed = _LOG_FIXED.unpack_from(buf, offset)
+				# joined, with a warning that expires
+				if fixed[0] & (_LOG_LEFT_BIT | _LOG_WARN_EXPIRY_BIT) != _LOG_LEFT_BIT:
+					continue
+				if now >= fixed[k]:
+					ret.append(id)
+				elif earliest is None or fixed[k] < earliest:
+					earliest = fixed[k]
+			# lowered again by setUser for warnings that remain
+			self.nextWarnExpiry = earliest if earliest is not None else 1 << 62
+			for id in ret:
+				with self.modifyUser(id=id) as user:
+					user.removeWarning()
+		return ret
+	def iterateUserIds(self):
+		with self.lock:
+			l = list(self.users.keys())
+		yield from l
+	def iterateUsers(self, joined=False, chunk=1000):
+		with self.lock:
+			ids = list(self.users.keys())
+		for i in range(0, len(ids), chunk):
+			l = []
+			with self.lock:
+				buf = self._buf()
+				for id in ids[i:i+chunk]:
+					e = self.users.get(id)
+					if e is None:
+						continue
+					# check the bitmask instead of decoding everything
+					if joined and not _LOG_ID.unpack_from(buf, e[0])[0] & _LOG_LEFT_BIT:
+						continue
+					l.append(SQLiteDatabase._userFromRow(_logDecodeUser(buf, e[0])))
+			yield from l
+	def getSystemConfig(self):
+		with self.lock:
+			if self.systemConfig is None:
+				return None
+			offset, length = self.systemConfig
+			d = json.loads(str(self._buf()[offset:offset+length], "utf-8"))
+		config = SystemConfig()
+		config.motd = d["motd"]
+		return config
+	def setSystemConfig(self, config):
+		payload = json.dumps({"motd": config.motd}).encode("utf-8")
+		with self.lock:
+			self._append(_LOG_SYSTEM_CONFIG, None, payload)
+
+# Resident user store (wraps another implementation)
+
+# index entries are a single id, or a set of ids if the key is shared
+# (obfuscated ids have only 20 bits, so that does happen)
+def _indexAdd(d, key, id):
+	v = d.get(key)
+	if v is None:
+		d[key] = id
+	elif isinstance(v, set):
+		v.add(id)
+	elif v != id:
+		d[key] = {v, id}
+
+def _indexRemove(d, key, id):
+	v = d.get(key)
+	if isinstance(v, set):
+		v.discard(id)
+		if len(v) == 1:
+			d[key] = v.pop()
+	elif v == id:
+		del d[key]
+
+class UserStore(Database):
+	def __init__(self, backend):
+		super(UserStore, self).__init__()
+		self.backend = backend
+		self.users = {} # dict(id -> User)
+		# lookup indexes over joined users
+		self.byName = {} # dict(lowercase username -> id or set of ids)
+		self.byOid = {} # dict(obfuscated id -> id or set of ids), only valid for oidDay
+		self.oidDay = None
+		self.dataVersion = None
+		self._load()
+	def _load(self):
+		with self.lock:
+			self.dataVersion = self.backend.getDataVersion()
+			self.users = {user.id: user for user in self.backend.iterateUsers()}
+			self.byName = {}
+			for user in self.users.values():
+				self._index(None, user)
+			self._rebuildOids()
+		logging.info("Loaded %d users into memory", len(self.users))
+	def _rebuildOids(self):
+		today = date.today()
+		d = {}
+		for user in self.users.values():
+			if user.isJoined():
+				_indexAdd(d, obfuscateId(user.id, today), user.id)
+		self.byOid, self.oidDay = d, today
+	def _index(self, old, new):
+		# updates the lookup indexes, old or new may be None
+		if old is not None and old.isJoined():
+			if old.username is not None:
+				_indexRemove(self.byName, old.username.lower(), old.id)
+			if self.oidDay is not None:
+				_indexRemove(self.byOid, obfuscateId(old.id, self.oidDay), old.id)
+		if new is not None and new.isJoined():
+			if new.username is not None:
+				_indexAdd(self.byName, new.username.lower(), new.id)
+			if self.oidDay is not None:
+				_indexAdd(self.byOid, obfuscateId(new.id, self.oidDay), new.id)
+	def register_tasks(self, sched):
+		self.backend.register_tasks(sched)
+		# pick up changes made by other processes (e.g. util/blacklist.py)
+		def f():
+			with self.lock:
+				if self.backend.getDataVersion() == self.dataVersion:
+					return
+				logging.info("Database was modified externally, reloading users")
+				self._load()
+			self.backend.checkPopulation()
+		sched.register(f, minutes=1)
+	def close(self):
+		self.backend.close()
+	def flush(self):
+		self.backend.flush()
+	def backup(self, dir, keep):
+		return self.backend.backup(dir, keep)
+	def getStats(self):
+		d = self.backend.getStats()
+		d.update(("store_" + k, v) for k, v in super(UserStore, self).getStats().items())
+		return d
+	# the User objects in `users` are never modified in-place, only replaced.
+	# this means reading them doesn't require the lock.
+	def getUser(self, id=None):
+		if id is None:
+			raise ValueError()
+		user = self.users.get(id)
+		if user is None:
+			user = self._unarchiveUser(id)
+		user = user.copy()
+		user.markClean()
+		return user
+	def _unarchiveUser(self, id):
+		with self.lock:
+			user = self.users.get(id)
+			if user is not None:
+				return user
+			user = self.backend.getUser(id=id) # raises KeyError
+			self._index(None, user)
+			self.users[id] = user
+			return user
+	def setUser(self, id, newuser):
+		if len(newuser.getModified()) == 0:
+			return
+		with self.lock:
+			self.backend.setUser(id, newuser)
+			newuser = newuser.copy()
+			self._index(self.users.get(id), newuser)
+			self.users[id] = newuser
+	def addUser(self, newuser):
+		with self.lock:
+			self.backend.addUser(newuser)
+			newuser = newuser.copy()
+			self._index(None, newuser)
+			self.users[newuser.id] = newuser
+	def iterateUserIds(self):
+		yield from list(self.users.keys())
+	def iterateUsers(self, joined=False):
+		# caller must not modify the returned objects
+		for user in list(self.users.values()):
+			if joined and not user.isJoined():
+				continue
+			yield user
+	def archiveUsers(self, before, limit=1000):
+		with self.lock:
+			ret = self.backend.archiveUsers(before, limit)
+			for id in ret:
+				self._index(self.users.pop(id, None), None)
+		return ret
+	def _lookup(self, id):
+		if isinstance(id, set):
+			for id in sorted(id):
+				user = self._lookup(id)
+				if user is not None:
+					return user
+			return None
+		if id is None:
+			return None
+		user = self.users.get(id)
+		if user is None or not user.isJoined():
+			return None
+		return self.getUser(id=id)
+	def getUserByName(self, username):
+		return self._lookup(self.byName.get(username.lower()))
+	def getUserByOid(self, oid):
+		if self.oidDay != date.today():
+			with self.lock:
+				if self.oidDay != date.today():
+					self._rebuildOids()
+		return self._lookup(self.byOid.get(oid))
+	def expireWarnings(self, now):
+		with self.lock:
+			ret = self.backend.expireWarnings(now)
+			for id in ret:
+				self.users[id] = self.backend.getUser(id=id)
+		return ret
+	def getPopulation(self):
+		return self.backend.getPopulation()
+	def checkPopulation(self):
+		return self.backend.checkPopulation()
+	def getSystemConfig(self):
+		return self.backend.getSystemConfig()
+	def setSystemConfig(self, config):
+		self.backend.setSystemConfig(config)
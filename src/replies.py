@@ -36,6 +36,7 @@ types = NumericEnum([
 	"USER_NOT_IN_CHAT",
 	"GIVEN_COOLDOWN",
 	"MESSAGE_REMOVED",
+	"MESSAGES_PURGED",
 	"PROMOTED_MOD",
 	"PROMOTED_ADMIN",
 	"KARMA_THANK_YOU",
@@ -64,6 +65,7 @@ types = NumericEnum([
 	"USER_INFO_MOD",
 	"USERS_INFO",
 	"USERS_INFO_EXTENDED",
+	"STATS",
 
 	"PROGRAM_VERSION",
 	"HELP_MODERATOR",
@@ -98,6 +100,7 @@ format_strs = {
 			(deleted and " (message also deleted)" or "") ),
 	types.MESSAGE_REMOVED: lambda reason, **_:
 		em("Your message has been removed" + (reason and " for {reason!x}. " or ". ") + "No cooldown has been given, but refrain from posting the message again."),
+	types.MESSAGES_PURGED: em("Deleted {count} messages."),
 	types.PROMOTED_MOD: em("You've been promoted to moderator, run /modhelp for a list of commands."),
 	types.PROMOTED_ADMIN: em("You've been promoted to admin, run /adminhelp for a list of commands."),
 	types.KARMA_THANK_YOU: em("You just gave this user some sweet karma, awesome!"),
@@ -145,6 +148,8 @@ format_strs = {
 	types.USERS_INFO_EXTENDED:
 		"<b>{active}</b> <i>active</i>, {inactive} <i>inactive and</i> "+
 		"{blacklisted} <i>blacklisted users</i> (<i>total</i>: {total})",
+	types.STATS: lambda stats, **_:
+		"\n".join("<b>%s</b>: %s" % (escape_html(k), escape_html(str(v))) for k, v in stats.items()),
 
 	types.PROGRAM_VERSION: "secretlounge-ng v{version} ~ https://github.com/sfan5/secretlounge-ng",
 	types.HELP_MODERATOR:
@@ -156,7 +161,8 @@ format_strs = {
 		"  /info - get info about the user that sent this message\n"+
 		"  /warn - warn the user that sent this message (cooldown)\n"+
 		"  /delete - delete a message and warn the user\n"+
-		"  /remove [reason] - delete a message without a cooldown",
+		"  /remove [reason] - delete a message without a cooldown\n"+
+		"  /purge - delete all messages by the user who sent this message that are still cached (about a day)",
 	types.HELP_ADMIN:
 		"<i>Admins can use the following commands</i>:\n"+
 		"  /adminhelp - show this text\n"+
@@ -165,6 +171,7 @@ format_strs = {
 		"  /uncooldown &lt;id | username&gt; - remove cooldown from an user\n"+
 		"  /mod &lt;username&gt; - promote an user to the moderator rank\n"+
 		"  /admin &lt;username&gt; - promote an user to the admin rank\n"+
+		"  /stats - show bot statistics\n"+
 		"\n"+
 		"<i>Or reply to a message and use</i>:\n"+
 		"  /blacklist [reason] - blacklist the user who sent this message",
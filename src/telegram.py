@@ -21,6 +21,7 @@ HIDE_FORWARD_FROM = set([
 	"AntiForwardedBot", "noforward_bot", "Anonymous_telegram_bot",
 ])
 VENUE_PROPS = ("title", "address", "foursquare_id", "foursquare_type", "google_place_id", "google_place_type")
+DELETE_BATCH = 100 # limit of deleteMessages
 
 # module variables
 bot = None
@@ -64,8 +65,8 @@ def init(config, _db, _ch):
 	cmds = [
 		"start", "stop", "users", "info", "motd", "toggledebug", "togglekarma",
 		"version", "source", "modhelp", "adminhelp", "modsay", "adminsay", "mod",
-		"admin", "warn", "delete", "remove", "uncooldown", "blacklist", "s", "sign",
-		"tripcode", "t", "tsign"
+		"admin", "warn", "delete", "remove", "purge", "uncooldown", "blacklist", "s", "sign",
+		"tripcode", "t", "tsign", "stats"
 	]
 	for c in cmds: # maps /<c> to the function cmd_<c>
 		c = c.lower()
@@ -104,8 +105,8 @@ def register_tasks(sched):
 			return False
 		message_queue.delete(f)
 		if n > 0:
-			logging.warning("Failed to deliver %d messages before they expired from cache.", n)
-	sched.register(task, hours=6) # (1/4) * cache duration
+			logging.warning("Failed to deliver %d messages before they expired or were evicted from cache.", n)
+	sched.register(task, minutes=5) # cheap, whole hours are dropped at once
 
 # Wraps a telegram user in a consistent class (used by core.py)
 class UserContainer():
@@ -426,7 +427,7 @@ def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None):
 	# set reply_to_message_id if applicable
 	reply_to = None
 	if reply_msid is not None:
-		reply_to = ch.lookupMapping(user.id, msid=reply_msid)
+		reply_to = ch.lookupMapping(user.id, msid=reply_msid, caller="reply")
 
 	user_id = user.id
 	def f():
@@ -442,6 +443,21 @@ def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None):
 		ch.saveMapping(user_id, msid, ev2.message_id)
 	put_into_queue(user, msid, f)
 
+def delete_messages(chat_id, ids):
+	# older versions of pyTelegramBotAPI don't have deleteMessages
+	if hasattr(bot, "delete_messages"):
+		return bot.delete_messages(chat_id, ids)
+	# one failing (e.g. already deleted) shouldn't stop the rest
+	for id in ids:
+		while True:
+			try:
+				bot.delete_message(chat_id, id)
+			except telebot.apihelper.ApiException as e:
+				retry = check_telegram_exc(e, None)
+				if retry:
+					continue
+			break
+
 # look at given Exception `e`, force-leave user if bot was blocked
 # returns True if message sending should be retried
 def check_telegram_exc(e, user_id):
@@ -475,9 +491,7 @@ class MyReceiver(core.Receiver):
 		if who is not None:
 			return send_to_single(m, msid, who, reply_msid=reply_msid)
 
-		for user in db.iterateUsers():
-			if not user.isJoined():
-				continue
+		for user in db.iterateUsers(joined=True):
 			if user == except_who and not user.debugEnabled:
 				continue
 			send_to_single(m, msid, user, reply_msid=reply_msid)
@@ -489,16 +503,16 @@ class MyReceiver(core.Receiver):
 		# FIXME: there's a hard to avoid race condition here:
 		# if a message is currently being sent, but finishes after we grab the
 		# message ids it will never be deleted
-		for user in db.iterateUsers():
-			if not user.isJoined():
+		for user_id, id in ch.getMappings(msid):
+			if user_id == except_id:
 				continue
-			if user.id == except_id:
+			try:
+				user = db.getUser(id=user_id)
+			except KeyError as e:
 				continue
-
-			id = ch.lookupMapping(user.id, msid=msid)
-			if id is None:
+			if not user.isJoined():
 				continue
-			user_id = user.id
+
 			def f(user_id=user_id, id=id):
 				while True:
 					try:
@@ -512,6 +526,34 @@ class MyReceiver(core.Receiver):
 			# queued message has msid=None here since this is a deletion, not a message being sent
 			put_into_queue(user, None, f)
 	@staticmethod
+	def purge(msids):
+		msids = set(msids)
+		message_queue.delete(lambda item: item.msid in msids)
+		# collect everything per chat first so that each one takes few API calls
+		chats = {}
+		for msid in msids:
+			tmp = ch.getMessage(msid)
+			except_id = None if tmp is None else tmp.user_id
+			for user_id, id in ch.getMappings(msid):
+				if user_id != except_id:
+					chats.setdefault(user_id, []).append(id)
+		for user in db.iterateUsers(joined=True):
+			ids = chats.get(user.id, None)
+			if ids is None:
+				continue
+
+			def f(user_id=user.id, ids=ids):
+				for i in range(0, len(ids), DELETE_BATCH):
+					while True:
+						try:
+							delete_messages(user_id, ids[i:i+DELETE_BATCH])
+						except telebot.apihelper.ApiException as e:
+							retry = check_telegram_exc(e, None)
+							if retry:
+								continue
+						break
+			put_into_queue(user, None, f)
+	@staticmethod
 	def stop_invoked(user, delete_out):
 		message_queue.delete(lambda item, user_id=user.id: item.user_id == user_id)
 		if not delete_out:
@@ -534,12 +576,14 @@ cmd_stop = wrap_core(core.user_leave)
 
 cmd_users = wrap_core(core.get_users)
 
+cmd_stats = wrap_core(core.get_stats, reply_to=True)
+
 def cmd_info(ev):
 	c_user = UserContainer(ev.from_user)
 	if ev.reply_to_message is None:
 		return send_answer(ev, core.get_info(c_user), True)
 
-	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id)
+	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id, caller="info")
 	if reply_msid is None:
 		return send_answer(ev, rp.Reply(rp.types.ERR_NOT_IN_CACHE), True)
 	return send_answer(ev, core.get_info_mod(c_user, reply_msid), True)
@@ -608,7 +652,7 @@ def cmd_warn(ev, delete=False, only_delete=False):
 	if ev.reply_to_message is None:
 		return send_answer(ev, rp.Reply(rp.types.ERR_NO_REPLY), True)
 
-	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id)
+	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id, caller="warn")
 	if reply_msid is None:
 		return send_answer(ev, rp.Reply(rp.types.ERR_NOT_IN_CACHE), True)
 	if only_delete:
@@ -640,19 +684,29 @@ def cmd_remove(ev, arg):
     if ev.reply_to_message is None:
         return send_answer(ev, rp.Reply(rp.types.ERR_NO_REPLY), True)
 
-    reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id)
+    reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id, caller="remove")
     if reply_msid is None:
         return send_answer(ev, rp.Reply(rp.types.ERR_NOT_IN_CACHE), True)
 
     send_answer(ev, core.remove(c_user, reply_msid, arg), True)
 
+def cmd_purge(ev):
+	c_user = UserContainer(ev.from_user)
+	if ev.reply_to_message is None:
+		return send_answer(ev, rp.Reply(rp.types.ERR_NO_REPLY), True)
+
+	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id, caller="purge")
+	if reply_msid is None:
+		return send_answer(ev, rp.Reply(rp.types.ERR_NOT_IN_CACHE), True)
+	return send_answer(ev, core.purge_messages(c_user, reply_msid), True)
+
 @takesArgument(optional=True)
 def cmd_blacklist(ev, arg):
 	c_user = UserContainer(ev.from_user)
 	if ev.reply_to_message is None:
 		return send_answer(ev, rp.Reply(rp.types.ERR_NO_REPLY), True)
 
-	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id)
+	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id, caller="blacklist")
 	if reply_msid is None:
 		return send_answer(ev, rp.Reply(rp.types.ERR_NOT_IN_CACHE), True)
 	return send_answer(ev, core.blacklist_user(c_user, reply_msid, arg), True)
@@ -662,7 +716,7 @@ def plusone(ev):
 	if ev.reply_to_message is None:
 		return send_answer(ev, rp.Reply(rp.types.ERR_NO_REPLY), True)
 
-	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id)
+	reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id, caller="upvote")
 	if reply_msid is None:
 		return send_answer(ev, rp.Reply(rp.types.ERR_NOT_IN_CACHE), True)
 	return send_answer(ev, core.give_karma(c_user, reply_msid), True)
@@ -723,15 +777,13 @@ def relay_inner(ev, *, caption_text=None, signed=False, tripcode=False):
 	# find out which message is being replied to
 	reply_msid = None
 	if ev.reply_to_message is not None:
-		reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id)
+		reply_msid = ch.lookupMapping(ev.from_user.id, data=ev.reply_to_message.message_id, caller="relay")
 		if reply_msid is None:
 			logging.warning("Message replied to not found in cache")
 
 	# relay message to all other users
 	logging.debug("relay(): msid=%d reply_msid=%r", msid, reply_msid)
-	for user2 in db.iterateUsers():
-		if not user2.isJoined():
-			continue
+	for user2 in db.iterateUsers(joined=True):
 		if user2 == user and not user.debugEnabled:
 			ch.saveMapping(user2.id, msid, ev.message_id)
 			continue
@@ -59,6 +59,42 @@ class MutablePriorityQueue():
 				if selector(self.items[iid]):
 					del self.items[iid]
 
+# Lock wrapper that keeps track of how long acquiring takes
+class TimedLock():
+	def __init__(self, lock):
+		self.lock = lock
+		# these are only modified while holding the lock
+		self.acquired = 0
+		self.contended = 0
+		self.waitTotal = 0.0 # seconds
+		self.waitMax = 0.0
+	def acquire(self, blocking=True):
+		if not self.lock.acquire(False):
+			if not blocking:
+				return False
+			t = time.monotonic()
+			self.lock.acquire()
+			t = time.monotonic() - t
+			self.contended += 1
+			self.waitTotal += t
+			self.waitMax = max(self.waitMax, t)
+		self.acquired += 1
+		return True
+	def release(self):
+		self.lock.release()
+	def __enter__(self):
+		self.acquire()
+		return self
+	def __exit__(self, *_):
+		self.release()
+	def getStats(self):
+		return {
+			"acquired": self.acquired,
+			"contended": self.contended,
+			"wait_total_ms": round(self.waitTotal * 1000),
+			"wait_max_ms": round(self.waitMax * 1000),
+		}
+
 class Enum():
 	def __init__(self, m, reverse=True):
 		assert len(set(m.values())) == len(m)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import sys
+import os
+import logging
+import time
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+from src.database import rotateBackups
+
+from blacklist import detect_db_paths
+
+def usage():
+	print("Back up databases while the bot is running (sqlite only)")
+	print("Usage: backup.py <destination dir> [number of backups to keep]")
+	print("Each database gets its own subdirectory in the destination")
+
+def main(argv):
+	logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M", level=logging.INFO)
+
+	if len(argv) not in (1, 2):
+		usage()
+		exit(1)
+	dest = argv[0]
+	keep = int(argv[1]) if len(argv) > 1 else 7
+
+	d = detect_db_paths()
+	if len(d) == 0:
+		logging.error("No database(s) detected, exiting!")
+		exit(1)
+	for name, path in d.items():
+		t = time.monotonic()
+		out = rotateBackups(path, os.path.join(dest, name), keep)
+		logging.info("%s: backed up to %s in %.1fs", name, out, time.monotonic() - t)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
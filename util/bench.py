@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+import sys
+import os
+import logging
+import tempfile
+import time
+import sqlite3
+import tracemalloc
+from threading import Thread
+from datetime import datetime, timedelta
+from random import Random, randint, random
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+from src.database import User, SystemConfig, USER_PROPS, USER_TIMESTAMP_PROPS
+from src.database import JSONDatabase, SQLiteDatabase, LogDatabase, UserStore
+from src.cache import Cache, CachedMessage
+
+from blacklist import print_function_help
+
+# helpers
+
+def make_users(n):
+	now = datetime.now()
+	for i in range(n):
+		u = User()
+		u.defaults()
+		u.id = 100000 + i
+		u.username = "user%d" % i if random() < 0.7 else None
+		u.realname = "User %d" % i
+		u.joined = now - timedelta(days=randint(0, 1000))
+		u.lastActive = now - timedelta(minutes=randint(0, 100000))
+		if random() < 0.6: # most people have left at some point
+			u.left = u.lastActive
+		if random() < 0.02:
+			u.setBlacklisted("spam")
+		u.karma = randint(-20, 200)
+		yield u
+
+def fill_sqlite(path, n):
+	db = SQLiteDatabase(path)
+	for u in make_users(n):
+		db.addUser(u)
+	db.close()
+
+def timeit(f, repeat):
+	t = time.perf_counter()
+	for _ in range(repeat):
+		f()
+	return (time.perf_counter() - t) / repeat
+
+# what telegram.relay_inner does for every message, minus the actual sending
+def relay_once(db):
+	n = 0
+	for user in db.iterateUsers(joined=True):
+		user.getMessagePriority()
+		n += 1
+	return n
+
+# frontend
+
+def c_relay(argv):
+	"""relay [users] [messages]
+		Relay cost per message with and without cache_users
+		defaults to 20000 users and 20 messages"""
+	if len(argv) > 2:
+		return Exception
+	n = int(argv[0]) if len(argv) > 0 else 20000
+	repeat = int(argv[1]) if len(argv) > 1 else 20
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, "db.sqlite")
+		fill_sqlite(path, n)
+
+		db = SQLiteDatabase(path)
+		t1 = timeit(lambda: relay_once(db), repeat)
+		db.close()
+
+		db = UserStore(SQLiteDatabase(path))
+		t2 = timeit(lambda: relay_once(db), repeat)
+		joined = relay_once(db)
+		db.close()
+	logging.info("%d users, %d joined", n, joined)
+	logging.info("sqlite:      %8.2f ms/message", t1 * 1000)
+	logging.info("cache_users: %8.2f ms/message (%.1fx)", t2 * 1000, t1 / t2)
+
+# how rows were decoded before timestamps were stored as integers
+def legacy_decode(path):
+	t = sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
+	conn = sqlite3.connect(path, detect_types=t)
+	conn.row_factory = sqlite3.Row
+	ret = []
+	for r in conn.execute("SELECT * FROM legacy"):
+		user = User()
+		for prop in r.keys():
+			setattr(user, prop, r[prop])
+		ret.append(user)
+	conn.close()
+	return ret
+
+def c_decode(argv):
+	"""decode [users]
+		Row decoding throughput of SQLiteDatabase.iterateUsers
+		defaults to 50000 users"""
+	if len(argv) > 1:
+		return Exception
+	n = int(argv[0]) if len(argv) > 0 else 50000
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, "db.sqlite")
+		fill_sqlite(path, n)
+
+		# same data with text timestamps, like the old schema
+		conn = sqlite3.connect(path)
+		conn.execute("CREATE TABLE legacy (" + ", ".join(
+			("`%s` TIMESTAMP" % prop) if prop in USER_TIMESTAMP_PROPS else ("`%s`" % prop)
+			for prop in USER_PROPS) + ")")
+		conn.execute("INSERT INTO legacy SELECT " + ", ".join(
+			("datetime(`%s`, 'unixepoch')" % prop) if prop in USER_TIMESTAMP_PROPS else ("`%s`" % prop)
+			for prop in USER_PROPS) + " FROM users")
+		conn.commit()
+		conn.close()
+
+		t1 = timeit(lambda: legacy_decode(path), 3)
+		db = SQLiteDatabase(path)
+		t2 = timeit(lambda: list(db.iterateUsers()), 3)
+		# includes converting the timestamps that the relay path reads
+		t3 = timeit(lambda: list(u.lastActive for u in db.iterateUsers() if u.isJoined()), 3)
+		db.close()
+	logging.info("%d users", n)
+	logging.info("sqlite3.Row + setattr: %9.0f rows/s", n / t1)
+	logging.info("positional decoding:   %9.0f rows/s (%.1fx)", n / t2, t1 / t2)
+	logging.info("  + lastActive access: %9.0f rows/s (%.1fx)", n / t3, t1 / t3)
+
+# same changes on every backend, so the results can be compared
+def mutate(db, ids, n, seed):
+	r = Random(seed)
+	base = datetime(2024, 1, 1)
+	for i in range(n):
+		with db.modifyUser(id=r.choice(ids)) as user:
+			k = r.randrange(4)
+			if k == 0:
+				user.lastActive = base + timedelta(seconds=i)
+				user.karma += r.randint(-3, 3)
+			elif k == 1:
+				user.left = base if user.isJoined() else None
+			elif k == 2:
+				user.username = "renamed%d" % r.randrange(1000) if r.random() < 0.8 else None
+			else:
+				user.warnings += 1
+				user.warnExpiry = base + timedelta(hours=i)
+
+def dump(db):
+	return {u.id: tuple(u.getEncoded(prop) for prop in USER_PROPS) for u in db.iterateUsers()}
+
+def c_backends(argv):
+	"""backends [users] [changes]
+		Compare the json, sqlite and log backends and check that they agree
+		defaults to 20000 users and 20000 changes"""
+	if len(argv) > 2:
+		return Exception
+	n = int(argv[0]) if len(argv) > 0 else 20000
+	changes = int(argv[1]) if len(argv) > 1 else 20000
+	users = list(make_users(n))
+	ids = list(u.id for u in users)
+	types = (("json", JSONDatabase), ("sqlite", SQLiteDatabase), ("log", LogDatabase))
+	results = {}
+	with tempfile.TemporaryDirectory() as tmp:
+		for name, cls in types:
+			path = os.path.join(tmp, name)
+			t = time.perf_counter()
+			db = cls(path)
+			for u in users:
+				db.addUser(u.copy())
+			c = SystemConfig()
+			c.motd = "hello"
+			db.setSystemConfig(c)
+			t1 = time.perf_counter() - t
+			t = time.perf_counter()
+			mutate(db, ids, changes, 1)
+			t2 = time.perf_counter() - t
+			db.close()
+
+			t = time.perf_counter()
+			db = cls(path)
+			t3 = time.perf_counter() - t
+			t4 = timeit(lambda: relay_once(db), 10)
+			sample = list(Random(2).choice(ids) for _ in range(1000))
+			t5 = timeit(lambda: list(db.getUser(id=id) for id in sample), 3) / len(sample)
+			results[name] = (dump(db), db.getPopulation(), db.getSystemConfig().motd)
+			db.close()
+			size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp) if f.startswith(name))
+			logging.info("%-6s  add %6.0f/s  change %6.0f/s  open %7.1f ms  relay %6.1f ms  getUser %5.1f us  %6d KiB",
+				name, n / t1, changes / t2, t3 * 1000, t4 * 1000, t5 * 1e6, size // 1024)
+
+		# the log backend again, without compacting on close
+		db = LogDatabase(os.path.join(tmp, "log2"))
+		for u in users:
+			db.addUser(u.copy())
+		mutate(db, ids, changes, 1)
+		db.setSystemConfig(c)
+		db.f.close()
+		db = LogDatabase(os.path.join(tmp, "log2"))
+		results["log (replayed)"] = (dump(db), db.getPopulation(), db.getSystemConfig().motd)
+		db.close()
+
+	expected = results.pop("sqlite")
+	for name, v in results.items():
+		if v != expected:
+			logging.error("%s differs from sqlite!", name)
+			return
+	logging.info("All backends agree (%d users)", len(expected[0]))
+
+# how mappings were stored before Cache used arrays
+def legacy_mappings(users, messages):
+	idmap, revmap = {}, {}
+	for msid in range(messages):
+		for uid in users:
+			idmap.setdefault(uid, {})[msid] = 1000 + msid
+			revmap.setdefault(uid, {})[1000 + msid] = msid
+	return idmap, revmap
+
+def fill_cache(users, messages):
+	ch = Cache()
+	for _ in range(messages):
+		msid = ch.assignMessageId(CachedMessage(users[0]))
+		for uid in users:
+			ch.saveMapping(uid, msid, 1000 + msid)
+	return ch
+
+# how messages were stored before Cache used columns
+def legacy_messages(messages):
+	msgs = {}
+	for msid in range(messages):
+		msgs[msid] = CachedMessage(100000 + msid % 1000)
+	return msgs
+
+def fill_messages(messages):
+	ch = Cache()
+	for msid in range(messages):
+		ch.assignMessageId(CachedMessage(100000 + msid % 1000))
+	return ch
+
+def c_cache(argv):
+	"""cache [users] [messages]
+		Memory used by message mappings and messages in the cache
+		defaults to 20000 users and 200 messages (each sent to everyone)"""
+	if len(argv) > 2:
+		return Exception
+	n = int(argv[0]) if len(argv) > 0 else 20000
+	m = int(argv[1]) if len(argv) > 1 else 200
+	users = list(range(100000, 100000 + n))
+	results = []
+	for name, f in (("dicts", legacy_mappings), ("arrays", fill_cache)):
+		tracemalloc.start()
+		t = time.perf_counter()
+		x = f(users, m)
+		t = time.perf_counter() - t
+		size = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		results.append(size)
+		logging.info("%-6s %8.1f MiB, %5.1f bytes/mapping, filled in %.1fs",
+			name, size / 2**20, size / (n * m), t)
+		del x
+	logging.info("%.1fx less memory", results[0] / results[1])
+
+	ch = fill_cache(users, m)
+	sample = list(Random(1).choice(users) for _ in range(10000))
+	t1 = timeit(lambda: list(ch.lookupMapping(uid, msid=m // 2) for uid in sample), 3)
+	t2 = timeit(lambda: list(ch.lookupMapping(uid, data=1000 + m // 2) for uid in sample), 3)
+	t3 = timeit(lambda: ch.getMappings(m // 2), 3)
+	logging.info("lookup by msid %.2f us, by message id %.2f us, all recipients of a message %.1f ms",
+		t1 / len(sample) * 1e6, t2 / len(sample) * 1e6, t3 * 1000)
+
+	m = 100000
+	results = []
+	for name, f in (("objects", legacy_messages), ("columns", fill_messages)):
+		tracemalloc.start()
+		x = f(m)
+		size = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		results.append(size)
+		logging.info("%-7s %6.1f MiB, %5.1f bytes/message", name, size / 2**20, size / m)
+		del x
+	logging.info("%.1fx less memory", results[0] / results[1])
+
+class FakeUser():
+	def __init__(self, id):
+		self.id = id
+
+# the telegram thread, the send thread(s) and the scheduler all at once
+def stress_cache(shards, senders, seconds, users):
+	ch = Cache(shards=shards)
+	msids = [ch.assignMessageId(CachedMessage(users[0]))]
+	counts = [0] * (senders + 2)
+	stop = time.monotonic() + seconds
+	def handler():
+		r = Random(0)
+		while time.monotonic() < stop:
+			msids.append(ch.assignMessageId(CachedMessage(r.choice(users))))
+			recent = msids[-50:]
+			ch.lookupMapping(r.choice(users), data=1000 + r.choice(recent))
+			ch.lookupMapping(r.choice(users), msid=r.choice(recent))
+			ch.getMessage(r.choice(recent)).addUpvote(FakeUser(r.choice(users)))
+			counts[0] += 4
+	def sender(k):
+		mine = users[k::senders]
+		last = None
+		while time.monotonic() < stop:
+			msid = msids[-1]
+			if msid == last:
+				time.sleep(0.001)
+				continue
+			for uid in mine:
+				ch.saveMapping(uid, msid, 1000 + msid)
+			counts[k + 2] += len(mine)
+			last = msid
+	def scheduler():
+		r = Random(1)
+		while time.monotonic() < stop:
+			ch.getMappings(r.choice(msids[-50:]))
+			ch.expire()
+			counts[1] += 2
+			time.sleep(0.01)
+	threads = [Thread(target=handler), Thread(target=scheduler)]
+	threads.extend(Thread(target=sender, args=(k, )) for k in range(senders))
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return counts, ch.getLockStats()
+
+def c_cachestress(argv):
+	"""cachestress [sender threads] [seconds]
+		Lock contention in the cache with one lock vs. several shards
+		defaults to 2 sender threads and 5 seconds per run"""
+	if len(argv) > 2:
+		return Exception
+	senders = int(argv[0]) if len(argv) > 0 else 2
+	seconds = float(argv[1]) if len(argv) > 1 else 5
+	users = list(range(100000, 102000))
+	for shards in (1, 8):
+		counts, stats = stress_cache(shards, senders, seconds, users)
+		logging.info("%d shard(s): %7.0f ops/s total, handler %6.0f ops/s",
+			shards, sum(counts) / seconds, counts[0] / seconds)
+		for name in ("alloc", "mappings", "messages"):
+			acquired = stats[name + "_acquired"]
+			logging.info("  %-8s %8d acquired, %6d contended (%4.1f%%), waited %5d ms total, %4d ms max",
+				name, acquired, stats[name + "_contended"],
+				stats[name + "_contended"] / max(acquired, 1) * 100,
+				stats[name + "_wait_total_ms"], stats[name + "_wait_max_ms"])
+
+def usage(actions):
+	print("Benchmarks for various parts of the bot")
+	print("Usage: bench.py <action> [arguments...]")
+	print("Actions:")
+	print_function_help(actions)
+
+def main(argv):
+	logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M", level=logging.INFO)
+
+	actions = {
+		"relay": c_relay, "decode": c_decode, "backends": c_backends,
+		"cache": c_cache, "cachestress": c_cachestress,
+	}
+
+	if len(argv) > 0:
+		action = argv[0].lower()
+		if action not in actions.keys():
+			logging.error("Unknown action")
+		else:
+			ret = actions[action](argv[1:])
+			if ret is not Exception: # lol
+				exit(0)
+
+	usage(actions)
+	exit(1)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
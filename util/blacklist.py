@@ -12,9 +12,12 @@ from time import sleep
 
 class Database():
 	def __init__(self, path):
-		t = sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
-		self.db = sqlite3.connect(path, detect_types=t)
+		self.db = sqlite3.connect(path)
 		self.db.row_factory = sqlite3.Row
+		# the bot moves users who left long ago to a separate table
+		c = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_archive'")
+		self.has_archive = c.fetchone() is not None
+		self.all_users = "all_users" if self.has_archive else "users"
 	def modify_custom(self, func):
 		while True:
 			try:
@@ -27,6 +30,14 @@ class Database():
 		self.db.commit()
 	def modify(self, sql, args=()):
 		self.modify_custom(lambda: self.db.execute(sql, args))
+	def unarchive(self, id):
+		# moves a user back into the main table so it can be modified
+		if not self.has_archive:
+			return
+		def f():
+			self.db.execute("INSERT OR IGNORE INTO users SELECT * FROM users_archive WHERE id = ?", (id, ))
+			self.db.execute("DELETE FROM users_archive WHERE id = ?", (id, ))
+		self.modify_custom(f)
 	# wrappers for standard functions
 	def execute(self, *args, **kwargs):
 		n = 1
@@ -61,6 +72,13 @@ def detect_db_paths():
 # other utility
 # NOTE: also imported
 
+# the bot stores timestamps as epoch seconds (treating local time as UTC)
+def to_timestamp(t):
+	return (t - datetime(1970, 1, 1)) // timedelta(seconds=1)
+
+def from_timestamp(n):
+	return datetime(1970, 1, 1) + timedelta(seconds=n)
+
 def detect_dbs():
 	d = detect_db_paths()
 	if len(d) == 0:
@@ -85,11 +103,12 @@ def print_function_help(table):
 # backend
 
 def ban_user(db, id, reason):
+	db.unarchive(id)
 	c = db.execute("SELECT rank FROM users WHERE id = ?", (id, ))
 	row = c.fetchone()
 	if row is None:
 		# user was never here, add an placeholder entry to still ban them
-		nodate = datetime.utcfromtimestamp(0)
+		nodate = 0
 		u = {
 			"id": id,
 			"realname": "",
@@ -109,16 +128,17 @@ def ban_user(db, id, reason):
 	elif row[0] == -10:
 		return 0, 0 # user was already banned
 	# update user values to ban them
-	param = (-10, datetime.now(), reason, id)
+	param = (-10, to_timestamp(datetime.now()), reason, id)
 	db.modify("UPDATE users SET rank = ?, left = ?, blacklistReason = ? WHERE id = ?", param)
 	return 1, 0
 
 def unban_user(db, id):
+	db.unarchive(id)
 	c = db.execute("SELECT realname, left FROM users WHERE id = ? AND rank = ?", (id, -10))
 	row = c.fetchone()
 	if row is None:
 		return 0
-	if row[0] == "" and row[1] == datetime.utcfromtimestamp(0):
+	if row[0] == "" and row[1] == 0:
 		# this is a placeholder entry, just delete it instead
 		db.modify("DELETE FROM users WHERE id = ?", (id, ))
 	else:
@@ -134,7 +154,7 @@ def sync(d):
 		# find all blacklists that happened since our last update
 		l = []
 		for name, db in d.items():
-			c = db.execute("SELECT id, blacklistReason FROM users WHERE rank = ? AND left >= ?", (-10, last_update))
+			c = db.execute("SELECT id, blacklistReason FROM users WHERE rank = ? AND left >= ?", (-10, to_timestamp(last_update)))
 			for row in c:
 				reason = row[1] or ""
 				if reason.endswith("]"): # transferred from elsewhere?
@@ -156,7 +176,8 @@ def sync(d):
 def find_user(db, term):
 	attrs = ("username", "realname", "rank", "joined", "left", "lastActive",
 		 "cooldownUntil", "blacklistReason", "warnings", "warnExpiry", "karma")
-	sql = "SELECT id, " + ",".join(attrs) + " FROM users WHERE"
+	dateattrs = ("joined", "left", "lastActive", "cooldownUntil", "warnExpiry")
+	sql = "SELECT id, " + ",".join(attrs) + " FROM " + db.all_users + " WHERE"
 	sql += " username LIKE ? OR realname LIKE ?"
 	args = ["%" + term + "%", "%" + term + "%"]
 	# numeric argument also searches for ID match
@@ -166,7 +187,9 @@ def find_user(db, term):
 	c = db.execute(sql, args)
 	ret = {}
 	for row in c:
-		ret[row[0]] = row[1:]
+		ret[row[0]] = tuple(
+			from_timestamp(v) if attr in dateattrs and v is not None else v
+			for attr, v in zip(attrs, row[1:]))
 	return ret, attrs
 
 # frontend
@@ -230,7 +253,7 @@ def c_find(d, argv):
 				a1 = next(i for i, s in enumerate(attrs) if s == "realname")
 				a2 = next(i for i, s in enumerate(attrs) if s == "left")
 				row = next(x for x in ret.values())
-				if row[a1] == "" and row[a2] == datetime.utcfromtimestamp(0):
+				if row[a1] == "" and row[a2] == from_timestamp(0):
 					print("In %s: (placeholder)" % dbname)
 					continue
 			print("In %s:" % dbname)
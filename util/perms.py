@@ -5,21 +5,22 @@ import logging
 from datetime import datetime, timedelta
 from time import sleep
 
-from blacklist import detect_dbs, print_function_help
+from blacklist import detect_dbs, print_function_help, from_timestamp
 
 # backend
 
 def list_privileged_users(db, cond="rank > 0"):
-	sql = "SELECT id, username, realname, rank, left, lastActive FROM users WHERE " + cond
+	sql = "SELECT id, username, realname, rank, left, lastActive FROM " + db.all_users + " WHERE " + cond
 	c = db.execute(sql)
 	ret = {}
 	for row in c:
 		user = ("@" + row[1]) if row[1] is not None else row[2]
-		active = None if row[4] is not None else row[5]
+		active = None if row[4] is not None else from_timestamp(row[5])
 		ret[row[0]] = (user, row[3], active)
 	return ret
 
 def set_user_rank(db, id, rank):
+	db.unarchive(id)
 	c = db.execute("SELECT 1 FROM users WHERE id = ?", (id, ))
 	if c.fetchone() is None:
 		return False